@@ -99,10 +99,15 @@ def run_infer(
     batch_size: int = 32,
     max_model_len: int = 15000,
     temperature: float = 0.0,
+    enable_prefix_caching: bool = False,
+    group_by_db: bool = False,
 ) -> List[str]:
     """
     Returns raw generated texts aligned with prompt_items.
     Each prompt item must contain a 'prompt' string.
+    With group_by_db, prompts are generated database by database so that batches
+    share the schema prefix (reused by vLLM's prefix cache); outputs are
+    restored to the input order.
     """
     # heuristic tp / util
     mp = model_path.lower()
@@ -120,6 +125,7 @@ def run_infer(
         gpu_memory_utilization=gpu_util,
         max_model_len=max_model_len,
         disable_custom_all_reduce=True,
+        enable_prefix_caching=enable_prefix_caching,
     )
     tok = llm.get_tokenizer()
 
@@ -134,7 +140,10 @@ def run_infer(
     )
 
     use_chat_template = ("sqlcoder-7b-2" not in mp)
-    prompts = [it["prompt"] for it in prompt_items]
+    order = list(range(len(prompt_items)))
+    if group_by_db:
+        order.sort(key=lambda i: prompt_items[i].get("db_id", ""))
+    prompts = [prompt_items[i]["prompt"] for i in order]
     generations = []
 
     for chunk in batches(prompts, batch_size):
@@ -156,7 +165,10 @@ def run_infer(
         for o in outs:
             generations.append(o.outputs[0].text)
 
-    return generations
+    ordered = [""] * len(prompt_items)
+    for i, text in zip(order, generations):
+        ordered[i] = text
+    return ordered
 
 # ----------------------------
 # Main: vLLM inference + postprocess
@@ -172,6 +184,10 @@ def main():
     ap.add_argument("--batch_size", type=int, default=50)
     ap.add_argument("--max_token_length", type=int, default=15000)
     ap.add_argument("--temperature", type=float, default=0.0)
+    ap.add_argument("--enable_prefix_caching", action="store_true",
+                    help="reuse the KV cache of shared prompt prefixes (e.g. the schema)")
+    ap.add_argument("--group_by_db", action="store_true",
+                    help="generate prompts database by database to maximize prefix reuse")
     args = ap.parse_args()
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
@@ -186,6 +202,8 @@ def main():
         batch_size=args.batch_size,
         max_model_len=args.max_token_length,
         temperature=args.temperature,
+        enable_prefix_caching=args.enable_prefix_caching,
+        group_by_db=args.group_by_db,
     )
 
     # 2) (optional) dump raw
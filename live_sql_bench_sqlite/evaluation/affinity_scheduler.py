@@ -0,0 +1,58 @@
+# affinity_scheduler.py
+"""
+Database-affinity scheduling of instances for the SQLite evaluation wrapper.
+
+Instances are grouped by selected_database. A wrapper thread keeps taking
+instances of the same database, so it keeps reusing one warm ephemeral copy
+(released and re-leased per instance) and one pool worker. When its group runs
+dry, the thread moves to the largest group nobody is working on yet, and once
+every group is taken it steals from the tail of the largest remaining one.
+"""
+import collections
+import threading
+
+
+class AffinityScheduler:
+    def __init__(self, instances_with_ids):
+        """
+        instances_with_ids: [(instance_data, instance_id), ...]
+        """
+        self.groups = collections.OrderedDict()
+        for instance_data, instance_id in instances_with_ids:
+            db_name = instance_data.get("selected_database", "unknown")
+            self.groups.setdefault(db_name, collections.deque()).append(
+                (instance_data, instance_id)
+            )
+        self.owners = collections.Counter()
+        self.switches = 0
+        self.steals = 0
+        self.lock = threading.Lock()
+
+    def next_instance(self, current_db=None):
+        """
+        The next (instance_data, instance_id) for a thread working on current_db,
+        or None when all instances have been handed out.
+        """
+        with self.lock:
+            if current_db is not None and self.groups.get(current_db):
+                return self.groups[current_db].popleft()
+            if current_db is not None:
+                self.owners[current_db] -= 1
+
+            remaining = [db_name for db_name, group in self.groups.items() if group]
+            if not remaining:
+                return None
+            unowned = [db_name for db_name in remaining if not self.owners[db_name]]
+            if unowned:
+                db_name = max(unowned, key=lambda name: len(self.groups[name]))
+                instance = self.groups[db_name].popleft()
+            else:
+                db_name = max(remaining, key=lambda name: len(self.groups[name]))
+                instance = self.groups[db_name].pop()
+                self.steals += 1
+            self.owners[db_name] += 1
+            self.switches += 1
+            return instance
+
+    def format_summary(self):
+        return f"Affinity schedule: {self.switches} database switches, {self.steals} steals"
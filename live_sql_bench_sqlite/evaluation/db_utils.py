@@ -1,4 +1,5 @@
 # db_utils.py
+import concurrent.futures
 import os
 import subprocess
 import sqlite3
@@ -14,6 +15,118 @@ import threading
 import time
 from logger import log_section_header, log_section_footer, PrintLogger, NullLogger
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# _IOW(0x94, 9, int) from linux/fs.h: share the source's extents (reflink)
+FICLONE = 0x40049409
+
+
+# SQLite VM instructions between two checks of a query's deadline
+PROGRESS_HANDLER_STEPS = 1000
+
+# Files SQLite keeps next to a database; a leftover -wal would be replayed
+# into a fresh copy created at the same path
+SIDECAR_SUFFIXES = ("-wal", "-shm", "-journal")
+
+# Connections opened by perform_query_on_sqlite_databases (conn=None) that are
+# still open; test cases often drop them unclosed, see close_opened_connections
+opened_connections = []
+
+# Row cap of SELECT results, and rows fetched per fetchmany() call
+MAX_ROWS = 10000
+FETCH_BATCH_SIZE = 1000
+
+
+class QueryResult(list):
+    """
+    Rows of a SELECT; truncated is True if the query returned more than
+    MAX_ROWS rows and only the first MAX_ROWS were fetched.
+    """
+
+    truncated = False
+
+
+def fetch_bounded(cursor, max_rows=MAX_ROWS):
+    """
+    Fetch at most max_rows rows, stepping the statement only one row past the
+    cap to detect truncation.
+    """
+    rows = QueryResult()
+    while len(rows) <= max_rows:
+        batch = cursor.fetchmany(min(FETCH_BATCH_SIZE, max_rows + 1 - len(rows)))
+        if not batch:
+            break
+        rows.extend(batch)
+    if len(rows) > max_rows:
+        del rows[max_rows:]
+        rows.truncated = True
+    return rows
+
+
+class SandboxTransactionLost(sqlite3.Error):
+    """
+    SQLite ended the sandbox's outer transaction early (e.g. an interrupted
+    statement or ON CONFLICT ROLLBACK), discarding the instance's changes.
+    """
+
+
+class SandboxConnection(sqlite3.Connection):
+    """
+    Connection whose changes are all kept in one outer transaction.
+    commit() and rollback() are no-ops so that perform_query_on_sqlite_databases
+    cannot end it; discard_changes() rolls everything back.
+    transaction_lost is set once SQLite is seen to have ended the transaction
+    itself; statements after that would run in autocommit against a state the
+    instance never produced, so perform_query_on_sqlite_databases refuses them.
+    """
+
+    transaction_lost = False
+
+    def check_transaction(self):
+        if not self.in_transaction:
+            self.transaction_lost = True
+        if self.transaction_lost:
+            raise SandboxTransactionLost("SQLite ended the sandbox transaction early")
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def discard_changes(self):
+        """
+        Roll back the outer transaction. Returns False if it already ended
+        (e.g. SQLite aborted it on an I/O error), in which case changes made
+        after that point may have been committed.
+        """
+        if self.transaction_lost or not self.in_transaction:
+            self.transaction_lost = True
+            if self.in_transaction:
+                self.execute("ROLLBACK")
+            return False
+        self.execute("ROLLBACK")
+        return True
+
+
+def open_sandbox_connection(db_path, logger, query_timeout=30):
+    """
+    Open a SandboxConnection on db_path with its outer transaction started
+    """
+    logger.info(f"Opening sandbox connection on db: {db_path}")
+    conn = sqlite3.connect(
+        db_path, timeout=query_timeout, factory=SandboxConnection, isolation_level=None
+    )
+    conn.execute(f"PRAGMA busy_timeout = {query_timeout * 1000}")
+    # these pragmas cannot be changed once the transaction has started
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("BEGIN")
+    return conn
+
 
 def perform_query_on_sqlite_databases(query, db_path, conn=None, query_timeout=30):
     """
@@ -21,32 +134,39 @@ def perform_query_on_sqlite_databases(query, db_path, conn=None, query_timeout=3
     Skip complex nested queries directly to avoid deadlock.
 
     Parameters:
-        query_timeout: Timeout for single query (seconds), default 15 seconds
+        query_timeout: Timeout for single query (seconds), default 30 seconds.
+            It bounds lock waits as well as execution: a progress handler aborts
+            the statement at the deadline and an OperationalError mentioning
+            "timeout" is raised, which execute_queries reports as timeout_error.
     """
-    MAX_ROWS = 10000
     need_to_close = False
 
     # Check query complexity, skip complex queries directly
     lower_q = query.strip().lower()
     if conn is None:
         conn = sqlite3.connect(db_path, timeout=query_timeout)
+        opened_connections.append(conn)
         conn.execute(f"PRAGMA busy_timeout = {query_timeout * 1000}")  # Set busy wait timeout to query_timeout seconds
         need_to_close = True
 
-    conn.execute("PRAGMA journal_mode = WAL")
-    conn.execute("PRAGMA synchronous = OFF")
+    if isinstance(conn, SandboxConnection):
+        conn.check_transaction()
+    else:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = OFF")
     
     cursor = conn.cursor()
 
+    deadline = time.monotonic() + query_timeout
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_HANDLER_STEPS)
+
     try:
         
         start_time = time.time()
         cursor.execute(query)
         
         if lower_q.startswith(('select', 'with')):
-            result = cursor.fetchall()
-            if result and len(result) > MAX_ROWS:
-                result = result[:MAX_ROWS]
+            result = fetch_bounded(cursor)
         else:
             conn.commit()
             try:
@@ -54,19 +174,27 @@ def perform_query_on_sqlite_databases(query, db_path, conn=None, query_timeout=3
             except Exception:
                 result = None
 
-        
+        if isinstance(conn, SandboxConnection):
+            conn.check_transaction()
         return (result, conn)
 
     except sqlite3.OperationalError as e:
         # print(f"[ERROR] SQLite OperationalError: {e}")
         conn.rollback()
+        if "interrupted" in str(e) and time.monotonic() > deadline:
+            raise sqlite3.OperationalError(
+                f"Query timeout: execution exceeded {query_timeout} seconds"
+            ) from e
         raise e
     except Exception as e:
         # print(f"[ERROR] Query failed: {e}")
         conn.rollback()
         raise e
     finally:
+        conn.set_progress_handler(None, 0)
         cursor.close()
+        if isinstance(conn, SandboxConnection) and not conn.in_transaction:
+            conn.transaction_lost = True
         if need_to_close:
             pass
 
@@ -143,15 +271,76 @@ def close_sqlite_connection(db_path, conn):
         conn.close()
 
 
+def close_opened_connections():
+    """
+    Close every connection opened by perform_query_on_sqlite_databases since
+    the last call. A connection a test case kept open would otherwise live on
+    in a persistent worker and keep the database's -wal past its reset.
+    Returns the number of connections closed.
+    """
+    closed = len(opened_connections)
+    while opened_connections:
+        opened_connections.pop().close()
+    return closed
+
+
 def get_connection_for_phase(db_path, logger):
     """
     Get new connection for specific phase
     """
     logger.info(f"Acquiring dedicated connection for phase on db: {db_path}")
     result, conn = perform_query_on_sqlite_databases("SELECT 1", db_path, conn=None)
+    opened_connections.remove(conn)  # closed by the caller
     return conn
 
 
+def copy_database_file(src, dst):
+    """
+    Copy src to dst as cheaply as the filesystem allows: a reflink (FICLONE) on
+    copy-on-write filesystems such as btrfs and XFS, else an in-kernel
+    os.copy_file_range, else a plain copy. Returns the method used.
+    """
+    method = None
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = "reflink"
+            except OSError:
+                pass
+        if method is None and hasattr(os, "copy_file_range"):
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                method = "copy_file_range"
+            except OSError:
+                # e.g. unsupported by the filesystem; start over with a plain copy
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+        if method is None:
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+            method = "copy"
+    shutil.copystat(src, dst)
+    return method
+
+
+def remove_database_files(db_path):
+    """
+    Delete db_path and its SIDECAR_SUFFIXES files, returning the removed paths
+    """
+    removed = []
+    for file_path in (db_path,) + tuple(f"{db_path}{suffix}" for suffix in SIDECAR_SUFFIXES):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            removed.append(file_path)
+    return removed
+
+
 def reset_and_restore_database(db_path, pg_password, logger):
     """
     Reset database by copying from template
@@ -212,81 +401,100 @@ def reset_and_restore_database(db_path, pg_password, logger):
             logger.error(f"Error listing directory {db_dir}: {e}")
             raise
 
-    # 1) Delete existing database
-    if os.path.exists(db_path):
-        os.remove(db_path)
-        logger.info(f"Database {db_path} removed.")
+    # 1) Delete existing database and its -wal/-shm/-journal files
+    for file_path in remove_database_files(db_path):
+        logger.info(f"Database file {file_path} removed.")
 
     # 2) Copy from template
-    shutil.copy2(template_db_path, db_path)
+    method = copy_database_file(template_db_path, db_path)
     logger.info(
-        f"Database {db_path} created from template {template_db_path} successfully."
+        f"Database {db_path} created from template {template_db_path} successfully ({method})."
     )
 
 
-def create_ephemeral_db_copies(base_db_names, num_copies, pg_password, logger):
+def find_template_path(db_root, base_db, logger):
     """
-    Create num_copies ephemeral copies for each base database
-    Return dictionary: {base_db: [ephemeral1_path, ephemeral2_path, ...], ...}
+    Locate the template database of base_db under db_root, falling back to any
+    *template*.sqlite file or the main database. Returns None if none exists.
     """
-    ephemeral_db_pool = {}
+    db_path = db_root
+    base_template_path = f"{db_path}/{base_db}/{base_db}_template.sqlite"
+
+    # Check and debug path
+    logger.info(f"Looking for template: {base_template_path}")
+
+    if not os.path.exists(base_template_path):
+        logger.warning(f"Template database not found: {base_template_path}")
+
+        # Debug: list directory content
+        db_dir = f"{db_path}/{base_db}"
+        if os.path.exists(db_dir):
+            files = os.listdir(db_dir)
+            logger.info(f"Files in {db_dir}: {files}")
+
+            # Look for template files
+            template_candidates = [
+                f for f in files if "template" in f and f.endswith(".sqlite")
+            ]
+            if template_candidates:
+                base_template_path = os.path.join(db_dir, template_candidates[0])
+                logger.info(f"Using template candidate: {base_template_path}")
+            else:
+                # Look for main database file
+                main_db_candidates = [f for f in files if f == f"{base_db}.sqlite"]
+                if main_db_candidates:
+                    base_template_path = os.path.join(db_dir, main_db_candidates[0])
+                    logger.info(
+                        f"Using main database as template: {base_template_path}"
+                    )
+                else:
+                    logger.error(f"No suitable database file found for {base_db}")
+                    return None
+        else:
+            logger.error(f"Database directory does not exist: {db_dir}")
+            return None
 
-    for base_db in base_db_names:
-        base_template_path = f"{db_path}/{base_db}/{base_db}_template.sqlite"
+    return base_template_path
 
-        # Check and debug path
-        logger.info(f"Looking for template: {base_template_path}")
 
-        if not os.path.exists(base_template_path):
-            logger.warning(f"Template database not found: {base_template_path}")
+def create_ephemeral_copy(template_path, base_db, index, logger, db_root="./database"):
+    """
+    Create (or recreate) ephemeral copy number index of base_db from its template
+    and return its path
+    """
+    ephemeral_name = f"{db_root}/{base_db}/{base_db}_ephemeral_{index}.sqlite"
 
-            # Debug: list directory content
-            db_dir = f"{db_path}/{base_db}"
-            if os.path.exists(db_dir):
-                files = os.listdir(db_dir)
-                logger.info(f"Files in {db_dir}: {files}")
+    # If already exists, delete first (with any -wal/-shm/-journal left behind)
+    remove_database_files(ephemeral_name)
 
-                # Look for template files
-                template_candidates = [
-                    f for f in files if "template" in f and f.endswith(".sqlite")
-                ]
-                if template_candidates:
-                    base_template_path = os.path.join(db_dir, template_candidates[0])
-                    logger.info(f"Using template candidate: {base_template_path}")
-                else:
-                    # Look for main database file
-                    main_db_candidates = [f for f in files if f == f"{base_db}.sqlite"]
-                    if main_db_candidates:
-                        base_template_path = os.path.join(db_dir, main_db_candidates[0])
-                        logger.info(
-                            f"Using main database as template: {base_template_path}"
-                        )
-                    else:
-                        logger.error(f"No suitable database file found for {base_db}")
-                        continue
-            else:
-                logger.error(f"Database directory does not exist: {db_dir}")
-                continue
+    # Copy from template
+    logger.info(f"Creating ephemeral db {ephemeral_name} from {template_path}...")
+    method = copy_database_file(template_path, ephemeral_name)
+    logger.info(f"Successfully created {ephemeral_name} ({method})")
+    return ephemeral_name
 
-        ephemeral_db_pool[base_db] = []
 
-        for i in range(1, num_copies + 1):
-            ephemeral_name = f"{db_path}/{base_db}/{base_db}_ephemeral_{i}.sqlite"
+def create_ephemeral_db_copies(base_db_names, num_copies, pg_password, logger, db_root="./database"):
+    """
+    Create num_copies ephemeral copies for each base database under db_root
+    Return dictionary: {base_db: [ephemeral1_path, ephemeral2_path, ...], ...}
+    """
+    ephemeral_db_pool = {}
 
-            # If already exists, delete first
-            if os.path.exists(ephemeral_name):
-                os.remove(ephemeral_name)
+    for base_db in base_db_names:
+        base_template_path = find_template_path(db_root, base_db, logger)
+        if base_template_path is None:
+            continue
 
-            # Copy from template
-            logger.info(
-                f"Creating ephemeral db {ephemeral_name} from {base_template_path}..."
-            )
+        ephemeral_db_pool[base_db] = []
+
+        for i in range(1, num_copies + 1):
             try:
-                shutil.copy2(base_template_path, ephemeral_name)
-                ephemeral_db_pool[base_db].append(ephemeral_name)
-                logger.info(f"Successfully created {ephemeral_name}")
+                ephemeral_db_pool[base_db].append(
+                    create_ephemeral_copy(base_template_path, base_db, i, logger, db_root)
+                )
             except Exception as e:
-                logger.error(f"Failed to create ephemeral db {ephemeral_name}: {e}")
+                logger.error(f"Failed to create ephemeral db {i} of {base_db}: {e}")
 
         logger.info(
             f"For base_db={base_db}, ephemeral db list = {ephemeral_db_pool[base_db]}"
@@ -295,18 +503,54 @@ def create_ephemeral_db_copies(base_db_names, num_copies, pg_password, logger):
     return ephemeral_db_pool
 
 
-def drop_ephemeral_dbs(ephemeral_db_pool_dict, pg_password, logger):
+def load_memory_database(template_path):
     """
-    Delete all ephemeral databases created during script execution
+    Load a template into memory with the backup API.
+    Returns (template_conn, working_conn): an untouched in-memory template and
+    an in-memory working copy for instances to run against.
+    """
+    source = sqlite3.connect(f"file:{template_path}?mode=ro", uri=True)
+    template_conn = sqlite3.connect(":memory:", check_same_thread=False)
+    try:
+        source.backup(template_conn)
+    finally:
+        source.close()
+    working_conn = sqlite3.connect(":memory:", check_same_thread=False)
+    template_conn.backup(working_conn)
+    return template_conn, working_conn
+
+
+def restore_memory_database(template_conn, working_conn):
+    """
+    Restore an in-memory working copy from its in-memory template
+    """
+    if working_conn.in_transaction:
+        working_conn.rollback()
+    template_conn.backup(working_conn)
+
+
+def drop_ephemeral_dbs(ephemeral_db_pool_dict, pg_password, logger, num_workers=8):
+    """
+    Delete all ephemeral databases created during script execution, together
+    with their -wal/-shm/-journal files, num_workers at a time
     """
     logger.info("=== Cleaning up ephemeral databases ===")
-    for base_db, ephemeral_list in ephemeral_db_pool_dict.items():
-        for ephemeral_db_path in ephemeral_list:
-            if os.path.exists(ephemeral_db_path):
-                logger.info(f"Dropping ephemeral db: {ephemeral_db_path}")
+
+    def drop(ephemeral_db_path):
+        for file_path in (ephemeral_db_path,) + tuple(
+            f"{ephemeral_db_path}{suffix}" for suffix in SIDECAR_SUFFIXES
+        ):
+            if os.path.exists(file_path):
+                logger.info(f"Dropping ephemeral db: {file_path}")
                 try:
-                    os.remove(ephemeral_db_path)
+                    os.remove(file_path)
                 except Exception as e:
-                    logger.error(
-                        f"Failed to drop ephemeral db {ephemeral_db_path}: {e}"
-                    )
\ No newline at end of file
+                    logger.error(f"Failed to drop ephemeral db {file_path}: {e}")
+
+    ephemeral_db_paths = [
+        ephemeral_db_path
+        for ephemeral_list in ephemeral_db_pool_dict.values()
+        for ephemeral_db_path in ephemeral_list
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(drop, ephemeral_db_paths))
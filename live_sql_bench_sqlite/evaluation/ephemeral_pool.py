@@ -0,0 +1,212 @@
+# ephemeral_pool.py
+"""
+Lease-based manager of the ephemeral database copies used by the wrapper.
+
+A wrapper thread checks a copy out for the duration of one instance and checks
+it back in afterwards, so two instances never run against the same copy.
+acquire() blocks while all copies of a database are leased. When it has waited
+grow_after seconds and the database has fewer than max_copies copies, it
+creates a new copy from the template instead of waiting any longer.
+With initial_copies=0, copies are only created on first lease, so databases
+that no instance uses are never copied.
+
+A released copy goes straight to the longest-waiting acquirer, so a thread
+that releases and re-acquires in a loop cannot starve the others; without
+waiters it is reused last-in first-out, keeping a thread on its warm copy.
+"""
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import threading
+import time
+import types
+
+from db_utils import create_ephemeral_copy, find_template_path
+from logger import NullLogger
+
+
+class LeaseTimeout(Exception):
+    pass
+
+
+class EphemeralDbPool:
+    """
+    Ephemeral copies of base_db_names under db_root.
+
+    initial_copies: copies created up front for each database, provision_workers
+        at a time; 0 creates them lazily on first lease.
+    max_copies: upper bound of copies per database, reached only under contention.
+    grow_after: seconds an acquire waits for a free copy before creating one.
+    """
+
+    def __init__(
+        self,
+        base_db_names,
+        db_root="./database",
+        initial_copies=1,
+        max_copies=1,
+        grow_after=0.5,
+        logger=None,
+        provision_workers=8,
+    ):
+        self.db_root = db_root
+        self.max_copies = max(max_copies, initial_copies)
+        self.grow_after = grow_after
+        self.logger = logger or NullLogger()
+        self.templates = {}
+        self.paths = {}
+        self.free = {}
+        self.waiters = {}
+        self.pending = collections.Counter()
+        self.indexes = {}
+        self.stats = {}
+        self.condition = threading.Condition()
+
+        for base_db in base_db_names:
+            template_path = find_template_path(db_root, base_db, self.logger)
+            if template_path is None:
+                continue
+            self.templates[base_db] = template_path
+            self.paths[base_db] = []
+            self.free[base_db] = collections.deque()
+            self.waiters[base_db] = collections.deque()
+            self.indexes[base_db] = itertools.count(1)
+            self.stats[base_db] = {
+                "leases": 0,
+                "waited_leases": 0,
+                "total_wait": 0.0,
+                "max_wait": 0.0,
+                "timeouts": 0,
+            }
+
+        if initial_copies:
+            jobs = [base_db for base_db in self.templates for _ in range(initial_copies)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=provision_workers) as executor:
+                for base_db, path in zip(jobs, executor.map(self._create_copy, jobs)):
+                    self.free[base_db].append(path)
+
+    def __contains__(self, base_db):
+        return base_db in self.templates
+
+    def template_path(self, base_db):
+        """
+        The template of base_db, for workers that only read it (in-memory mode);
+        it is never leased out.
+        """
+        return self.templates[base_db]
+
+    def _create_copy(self, base_db):
+        with self.condition:
+            index = next(self.indexes[base_db])
+        path = create_ephemeral_copy(
+            self.templates[base_db], base_db, index, self.logger, self.db_root
+        )
+        with self.condition:
+            self.paths[base_db].append(path)
+        return path
+
+    def _record_lease(self, base_db, wait):
+        stats = self.stats[base_db]
+        stats["leases"] += 1
+        stats["total_wait"] += wait
+        stats["max_wait"] = max(stats["max_wait"], wait)
+        if wait > 0.001:
+            stats["waited_leases"] += 1
+
+    def acquire(self, base_db, timeout=None):
+        """
+        Check out a copy of base_db, waiting at most timeout seconds
+        (None: forever) before raising LeaseTimeout.
+        """
+        start = time.monotonic()
+        with self.condition:
+            if self.free[base_db] and not self.waiters[base_db]:
+                self._record_lease(base_db, 0.0)
+                return self.free[base_db].pop()
+
+            waiter = types.SimpleNamespace(path=None)
+            self.waiters[base_db].append(waiter)
+            try:
+                while waiter.path is None:
+                    waited = time.monotonic() - start
+                    num_copies = len(self.paths[base_db]) + self.pending[base_db]
+                    can_grow = num_copies < self.max_copies
+                    if can_grow and (waited >= self.grow_after or num_copies == 0):
+                        self.pending[base_db] += 1
+                        break
+                    wait = None
+                    if timeout is not None:
+                        wait = timeout - waited
+                        if wait <= 0:
+                            self.stats[base_db]["timeouts"] += 1
+                            raise LeaseTimeout(
+                                f"No ephemeral database of {base_db} free after {timeout} seconds"
+                            )
+                    if can_grow:
+                        grow_wait = self.grow_after - waited
+                        wait = grow_wait if wait is None else min(wait, grow_wait)
+                    self.condition.wait(wait)
+            finally:
+                if waiter.path is None:
+                    self.waiters[base_db].remove(waiter)
+            if waiter.path is not None:
+                self._record_lease(base_db, time.monotonic() - start)
+                return waiter.path
+
+        # create the extra copy outside the lock; it is leased to this caller
+        self.logger.info(f"All copies of {base_db} are busy, creating another one")
+        try:
+            path = self._create_copy(base_db)
+        finally:
+            with self.condition:
+                self.pending[base_db] -= 1
+                self.condition.notify_all()
+        with self.condition:
+            self._record_lease(base_db, time.monotonic() - start)
+        return path
+
+    def release(self, base_db, path):
+        with self.condition:
+            if self.waiters[base_db]:
+                # hand over to the longest-waiting acquirer
+                self.waiters[base_db].popleft().path = path
+                self.condition.notify_all()
+            else:
+                self.free[base_db].append(path)
+
+    @contextlib.contextmanager
+    def lease(self, base_db, timeout=None):
+        path = self.acquire(base_db, timeout)
+        try:
+            yield path
+        finally:
+            self.release(base_db, path)
+
+    def all_copies(self):
+        """
+        {base_db: [ephemeral paths]}, in the format of create_ephemeral_db_copies
+        """
+        with self.condition:
+            return {base_db: list(paths) for base_db, paths in self.paths.items()}
+
+    def summary(self):
+        with self.condition:
+            summary = {}
+            for base_db, stats in self.stats.items():
+                summary[base_db] = dict(
+                    stats,
+                    copies=len(self.paths[base_db]),
+                    mean_wait=stats["total_wait"] / stats["leases"] if stats["leases"] else 0.0,
+                )
+            return summary
+
+    def format_summary(self):
+        lines = ["Ephemeral database leases:"]
+        for base_db, stats in sorted(self.summary().items()):
+            lines.append(
+                f"  {base_db}: {stats['leases']} leases, {stats['waited_leases']} waited "
+                f"(mean {stats['mean_wait']:.3f}s, max {stats['max_wait']:.3f}s), "
+                f"{stats['timeouts']} timeouts, {stats['copies']} copies"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,51 @@
+# framing.py
+"""
+Length-prefixed JSON frames for passing instance payloads and results
+between the wrapper and single_instance_eval_sqlite.py over stdin/stdout,
+without temporary files.
+
+Frame layout: 4-byte big-endian payload length, then the UTF-8 JSON payload.
+"""
+import json
+import struct
+
+HEADER = struct.Struct(">I")
+
+
+def encode_frame(obj):
+    payload = json.dumps(obj).encode("utf-8")
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_frame(data):
+    """
+    Decode the first frame of data; raise ValueError if it is truncated.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError(f"Incomplete frame header ({len(data)} bytes)")
+    (length,) = HEADER.unpack_from(data)
+    payload = data[HEADER.size : HEADER.size + length]
+    if len(payload) < length:
+        raise ValueError(f"Incomplete frame: expected {length} bytes, got {len(payload)}")
+    return json.loads(payload.decode("utf-8"))
+
+
+def write_frame(stream, obj):
+    stream.write(encode_frame(obj))
+    stream.flush()
+
+
+def read_frame(stream):
+    """
+    Read one frame from a binary stream; return None at end of stream.
+    """
+    header = stream.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise ValueError(f"Incomplete frame header ({len(header)} bytes)")
+    (length,) = HEADER.unpack(header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        raise ValueError(f"Incomplete frame: expected {length} bytes, got {len(payload)}")
+    return json.loads(payload.decode("utf-8"))
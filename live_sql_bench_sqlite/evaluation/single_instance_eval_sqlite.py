@@ -15,15 +15,19 @@ import gc
 from datetime import date
 
 # Local imports
+from framing import read_frame, write_frame
 from logger import configure_logger, NullLogger
 from utils import load_jsonl, split_field
 from db_utils import (
     perform_query_on_sqlite_databases,
+    close_opened_connections,
     close_sqlite_connection,
     execute_queries,
     get_connection_for_phase,
     reset_and_restore_database,
+    open_sandbox_connection,
 )
+from sql_classifier import can_run_in_sandbox, database_fingerprint, instance_can_mutate
 from test_utils import (
     check_sql_function_usage,
     remove_round,
@@ -161,8 +165,13 @@ def run_preprocessing(preprocess_sql, db_path, logger, conn):
         execute_queries(preprocess_sql, db_path, conn, logger, section_title="Preprocess SQL")
 
 
-def evaluate_instance(data, args, logger):
-    """Evaluate a single instance and return results"""
+def evaluate_instance(data, args, logger, db_connection=None):
+    """
+    Evaluate a single instance and return results.
+    If db_connection is given (e.g. an in-memory working copy), it is used as is
+    and the caller is responsible for closing and restoring it; db_path is then
+    ":memory:", so a test case connecting to db_path never reaches a file.
+    """
     instance_id = data.get("instance_id", "unknown")
     
     # Check for required fields
@@ -210,19 +219,52 @@ def evaluate_instance(data, args, logger):
 
     # 🔧 CRITICAL FIX: Determine database path correctly
     ephemeral_db_path = os.environ.get("EPHEMERAL_DB_PATH")
-    if ephemeral_db_path and os.path.exists(ephemeral_db_path):
+    if db_connection is not None:
+        ephemeral_db_path = None
+        db_path = ":memory:"
+        logger.info("Using the given database connection")
+    elif ephemeral_db_path and os.path.exists(ephemeral_db_path):
         db_path = ephemeral_db_path
         logger.info(f"Using ephemeral database: {db_path}")
     else:
         db_path = f"./database/{db_name}/{db_name}.sqlite"
         logger.info(f"Using main database: {db_path}")
+
+    # Read-only instances should not change the database, so its reset is
+    # skipped if the database fingerprint is unchanged afterwards ("verify"),
+    # or unconditionally with the explicit opt-in "skip"
+    read_only_reset = getattr(args, "read_only_reset", "verify")
+    read_only = read_only_reset != "always" and not instance_can_mutate(data, args.mode)
+    read_only_clean = False
+    fingerprint = None
+    if read_only:
+        logger.info("Instance is read-only")
+
+    # Sandbox mode: run everything in one outer transaction and roll it back
+    # instead of copying the template over the ephemeral database afterwards
+    owns_connection = db_connection is None
+    use_sandbox = (
+        owns_connection
+        and not read_only
+        and getattr(args, "sandbox", "false") == "true"
+        and db_path == ephemeral_db_path
+        and can_run_in_sandbox(preprocess_sql + pred_sqls + sol_sqls + clean_up_sql, test_cases)
+    )
+    sandbox_clean = False
+    sandbox_lost = False
+    if use_sandbox:
+        logger.info("Using transactional sandbox")
+    elif getattr(args, "sandbox", "false") == "true" and owns_connection and not read_only:
+        logger.info("Instance cannot run in the sandbox, resetting the database file instead")
     
-    # Get connection with retry
-    db_connection = None
+    # Get connection with retry (skipped for a caller-provided connection)
     max_retries = 3
-    for attempt in range(max_retries):
+    for attempt in range(max_retries if owns_connection else 0):
         try:
-            db_connection = get_connection_for_phase(db_path, logger)
+            if use_sandbox:
+                db_connection = open_sandbox_connection(db_path, logger)
+            else:
+                db_connection = get_connection_for_phase(db_path, logger)
             if db_connection:
                 break
         except Exception as e:
@@ -242,6 +284,9 @@ def evaluate_instance(data, args, logger):
             time.sleep(1)  # Reduced wait time
 
     try:
+        if read_only and read_only_reset == "verify" and owns_connection:
+            fingerprint = database_fingerprint(db_connection)
+
         logger.info("=== Starting Evaluation Phase ===")
 
         # Run preprocessing SQL
@@ -275,7 +320,7 @@ def evaluate_instance(data, args, logger):
             evaluation_phase_assertion_error):
             ret_status = "failed"
 
-        return {
+        result = {
             "instance_id": instance_id,
             "status": ret_status,
             "error_message": eval_error_message,
@@ -290,7 +335,7 @@ def evaluate_instance(data, args, logger):
     except Exception as e:
         logger.error(f"Unexpected error evaluating instance: {e}")
         logger.error(traceback.format_exc())
-        return {
+        result = {
             "instance_id": instance_id,
             "status": "failed",
             "error_message": f"Unexpected error: {str(e)}",
@@ -302,49 +347,123 @@ def evaluate_instance(data, args, logger):
             "evaluation_phase_assertion_error": False,
         }
     finally:
-        if db_connection:
+        if db_connection and use_sandbox:
+            try:
+                sandbox_clean = db_connection.discard_changes()
+            except Exception as e:
+                logger.error(f"Error rolling back sandbox: {e}")
+            # the instance did not run against the state file mode would give
+            sandbox_lost = not sandbox_clean
+            if sandbox_lost:
+                logger.error(
+                    "Sandbox transaction ended early, resetting the database and "
+                    "re-running the instance without the sandbox"
+                )
+
+        if read_only and db_connection and owns_connection:
+            if read_only_reset == "verify":
+                try:
+                    read_only_clean = fingerprint is not None and (
+                        database_fingerprint(db_connection) == fingerprint
+                    )
+                except Exception as e:
+                    logger.error(f"Error verifying database fingerprint: {e}")
+                if not read_only_clean:
+                    logger.error("Read-only instance changed the database, resetting it")
+            else:
+                read_only_clean = True
+
+        if db_connection and owns_connection:
             try:
                 close_sqlite_connection(db_path, db_connection)
             except Exception as e:
                 logger.error(f"Error closing connection: {e}")
 
-        # Reset database only if using ephemeral
-        if ephemeral_db_path and os.path.exists(ephemeral_db_path):
+        # Close connections the test cases opened and did not close (and
+        # collect unreachable ones) before the database files are replaced
+        try:
+            leaked = close_opened_connections()
+            if leaked:
+                logger.info(f"Closed {leaked} connection(s) left open by the instance")
+        except Exception as e:
+            logger.error(f"Error closing leftover connections: {e}")
+        gc.collect()
+
+        # Reset database only if using ephemeral and it may have been changed
+        if read_only_clean:
+            logger.info("Skipping database reset for read-only instance")
+        elif (
+            owns_connection
+            and ephemeral_db_path
+            and os.path.exists(ephemeral_db_path)
+            and not sandbox_clean
+        ):
             try:
                 reset_and_restore_database(db_path, "123123", logger)
             except Exception as e:
                 logger.error(f"Error during database reset: {e}")
 
-        gc.collect()
+    if sandbox_lost:
+        return evaluate_instance(data, argparse.Namespace(**dict(vars(args), sandbox="false")), logger)
+    return result
 
 
 def main():
     parser = argparse.ArgumentParser(description="Execute a single SQL solution and test case (SQLite).")
-    parser.add_argument("--jsonl_file", help="Path to the JSONL file containing the dataset instance.", required=True)
-    parser.add_argument("--output_file", required=True, help="Path to the JSON file for output with evaluation results.")
+    parser.add_argument("--jsonl_file", help="Path to the JSONL file containing the dataset instance.")
+    parser.add_argument("--output_file", help="Path to the JSON file for output with evaluation results.")
+    parser.add_argument(
+        "--ipc", choices=["file", "stdio"], default="file",
+        help="file: --jsonl_file/--output_file; stdio: length-prefixed JSON frames on stdin/stdout",
+    )
     parser.add_argument("--mode", help="gold or pred", choices=["gold", "pred"], default="pred")
     parser.add_argument("--logging", type=str, default="true", help="Enable or disable logging ('true' or 'false').")
     parser.add_argument("--log_file", type=str, help="Specific path for the log file.")
+    parser.add_argument(
+        "--sandbox", type=str, default="false",
+        help="Roll back a transaction instead of copying the template after the instance ('true' or 'false').",
+    )
+    parser.add_argument(
+        "--read_only_reset", choices=["always", "skip", "verify"], default="verify",
+        help="Reset the database after read-only instances always, only if its fingerprint changed "
+        "(verify, the default), or never (skip, trusting the static read-only check).",
+    )
 
     args = parser.parse_args()
+    if args.ipc == "file" and not (args.jsonl_file and args.output_file):
+        parser.error("--jsonl_file and --output_file are required with --ipc file")
+
+    # stdout carries the result frame; stray prints go to stderr instead
+    result_stream = sys.stdout.buffer
+    if args.ipc == "stdio":
+        sys.stdout = sys.stderr
 
     try:
         # Load the data (expecting only one instance)
-        data_list = load_jsonl(args.jsonl_file)
-        if not data_list:
-            print("No data found in the JSONL file.")
-            sys.exit(1)
+        if args.ipc == "stdio":
+            data = read_frame(sys.stdin.buffer)
+            if data is None:
+                print("No instance received on stdin.")
+                sys.exit(1)
+        else:
+            data_list = load_jsonl(args.jsonl_file)
+            if not data_list:
+                print("No data found in the JSONL file.")
+                sys.exit(1)
 
-        data = data_list[0]  # Get the single instance
+            data = data_list[0]  # Get the single instance
         instance_id = data.get("instance_id", 0)
 
         # Configure logger
         if args.logging == "true":
             if args.log_file:
                 log_filename = args.log_file
-            else:
+            elif args.jsonl_file:
                 log_filename = os.path.splitext(args.jsonl_file)[0] + f"_instance_{instance_id}.log"
                 print(f"Using log file: {log_filename}")
+            else:
+                log_filename = f"instance_{instance_id}.log"
+                print(f"Using log file: {log_filename}")
             logger = configure_logger(log_filename)
         else:
             logger = NullLogger()
@@ -355,8 +474,11 @@ def main():
         evaluation_result = evaluate_instance(data, args, logger)
 
         # Write the output
-        with open(args.output_file, "w") as f:
-            json.dump(evaluation_result, f)
+        if args.ipc == "stdio":
+            write_frame(result_stream, evaluation_result)
+        else:
+            with open(args.output_file, "w") as f:
+                json.dump(evaluation_result, f)
 
         logger.info(f"Evaluation completed for instance {instance_id}: {evaluation_result['status']}")
         sys.exit(0)
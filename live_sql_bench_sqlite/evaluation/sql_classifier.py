@@ -0,0 +1,265 @@
+# sql_classifier.py
+"""
+Static checks of the SQL and test cases of an instance:
+- whether it can change its database, so that read-only (SELECT-only)
+  instances can skip the database reset;
+- whether it can run inside the transactional sandbox.
+
+SQL is tokenized with string literals, quoted identifiers and comments
+removed, so keywords that only appear inside them do not count, while a
+statement following a WITH clause (e.g. WITH ... DELETE) is still seen.
+Test cases are Python code: every string constant in them is checked as SQL.
+The checks err on the safe side: anything they cannot parse can mutate and
+cannot run in the sandbox.
+"""
+import ast
+import re
+
+from utils import split_field
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+    |(?P<string>'(?:[^']|'')*'?)
+    |(?P<quoted>"(?:[^"]|"")*"?|`(?:[^`]|``)*`?|\[[^\]]*\]?)
+    |(?P<word>\w+)
+    |(?P<punct>[^\s\w])
+    """,
+    re.DOTALL | re.VERBOSE,
+)
+
+# Read-only introspection pragmas that are safe inside a transaction
+READ_ONLY_PRAGMAS = {
+    "table_info",
+    "table_xinfo",
+    "table_list",
+    "index_list",
+    "index_info",
+    "index_xinfo",
+    "foreign_key_list",
+    "database_list",
+    "collation_list",
+    "function_list",
+    "compile_options",
+}
+
+# Statements that cannot run inside the sandbox's outer transaction
+NON_TRANSACTIONAL_KEYWORDS = {
+    "BEGIN",
+    "COMMIT",
+    "END",
+    "ROLLBACK",
+    "SAVEPOINT",
+    "RELEASE",
+    "VACUUM",
+    "ATTACH",
+    "DETACH",
+}
+
+# Test case helpers that open their own connection unless given conn
+# (positional index of their conn parameter)
+CONNECTION_HELPERS = {
+    "perform_query_on_sqlite_databases": 2,
+    "execute_queries": 2,
+}
+
+# DML, DDL (including CREATE VIEW/TRIGGER/INDEX) and maintenance statements
+MUTATING_KEYWORDS = {
+    "INSERT",
+    "UPDATE",
+    "DELETE",
+    "CREATE",
+    "DROP",
+    "ALTER",
+    "VACUUM",
+    "ATTACH",
+    "DETACH",
+    "REINDEX",
+    "ANALYZE",
+}
+
+
+def tokenize(sql):
+    """
+    Upper-cased words and punctuation of sql, without string literals,
+    quoted identifiers and comments.
+    """
+    return [
+        match.group().upper()
+        for match in TOKEN_PATTERN.finditer(sql)
+        if match.lastgroup in ("word", "punct")
+    ]
+
+
+def is_read_only_pragma(tokens):
+    """
+    Whether the tokens following PRAGMA query a read-only pragma
+    (e.g. table_info(t)) rather than set or run one.
+    """
+    if len(tokens) >= 3 and tokens[1] == ".":
+        tokens = tokens[2:]  # schema-qualified: PRAGMA main.table_info(t)
+    if not tokens or tokens[0].lower() not in READ_ONLY_PRAGMAS:
+        return False
+    return len(tokens) < 2 or tokens[1] != "="
+
+
+def statement_can_mutate(sql):
+    if not isinstance(sql, str):
+        return True
+    tokens = tokenize(sql)
+    for i, token in enumerate(tokens):
+        if token in MUTATING_KEYWORDS:
+            return True
+        # REPLACE INTO ... as opposed to the replace() string function
+        if token == "REPLACE" and tokens[i + 1 : i + 2] != ["("]:
+            return True
+        if token == "PRAGMA" and not is_read_only_pragma(tokens[i + 1 :]):
+            return True
+    return False
+
+
+def split_statements(tokens):
+    """
+    Split tokens into statements at ";", keeping the body of a CREATE TRIGGER
+    (BEGIN ...; ... END) in its statement.
+    """
+    statements, current = [], []
+    in_trigger, case_depth = False, 0
+    for token in tokens:
+        if token == ";" and not in_trigger:
+            if current:
+                statements.append(current)
+            current = []
+            continue
+        current.append(token)
+        if token == "TRIGGER" and current[0] == "CREATE":
+            in_trigger = True
+        elif in_trigger and token == "CASE":
+            case_depth += 1
+        elif in_trigger and token == "END":
+            if case_depth:
+                case_depth -= 1
+            else:
+                in_trigger = False
+    if current:
+        statements.append(current)
+    return statements
+
+
+def statement_can_run_in_sandbox(sql):
+    if not isinstance(sql, str):
+        return False
+    for statement in split_statements(tokenize(sql)):
+        if statement[0] in NON_TRANSACTIONAL_KEYWORDS:
+            return False
+        for i, token in enumerate(statement):
+            if token == "PRAGMA" and not is_read_only_pragma(statement[i + 1 :]):
+                return False
+    return True
+
+
+def parse_test_case(test_case_code):
+    """
+    The AST of a test case, or None if it cannot be parsed.
+    """
+    try:
+        return ast.parse(test_case_code)
+    except (SyntaxError, ValueError, TypeError):
+        return None
+
+
+def string_constants(tree):
+    return [
+        node.value
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Constant) and isinstance(node.value, str)
+    ]
+
+
+def call_name(call):
+    if isinstance(call.func, ast.Name):
+        return call.func.id
+    if isinstance(call.func, ast.Attribute):
+        return call.func.attr
+    return None
+
+
+def opens_own_connection(tree):
+    """
+    Whether test case code connects to the database itself (sqlite3.connect,
+    or a query helper called without conn) instead of using the given conn.
+    """
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        name = call_name(node)
+        if name == "connect":
+            return True
+        if name not in CONNECTION_HELPERS:
+            continue
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(
+            kw.arg is None for kw in node.keywords
+        ):
+            return True  # *args/**kwargs: cannot tell whether conn is passed
+        conn_index = CONNECTION_HELPERS[name]
+        conn_args = [kw.value for kw in node.keywords if kw.arg == "conn"]
+        if len(node.args) > conn_index:
+            conn_args.append(node.args[conn_index])
+        if not conn_args or all(
+            isinstance(arg, ast.Constant) and arg.value is None for arg in conn_args
+        ):
+            return True
+    return False
+
+
+def test_case_can_mutate(test_case_code):
+    tree = parse_test_case(test_case_code)
+    if tree is None:
+        return True
+    return any(statement_can_mutate(value) for value in string_constants(tree))
+
+
+def test_case_opens_connection(test_case_code):
+    tree = parse_test_case(test_case_code)
+    return tree is None or opens_own_connection(tree)
+
+
+def can_run_in_sandbox(sql_statements, test_cases):
+    """
+    Whether an instance can run inside one outer transaction that is rolled
+    back afterwards: no statement ends or escapes the transaction, and no test
+    case opens its own connection, which would not see the uncommitted changes.
+    """
+    if not all(statement_can_run_in_sandbox(sql) for sql in sql_statements):
+        return False
+    for test_case_code in test_cases:
+        tree = parse_test_case(test_case_code)
+        if tree is None or opens_own_connection(tree):
+            return False
+        if not all(statement_can_run_in_sandbox(value) for value in string_constants(tree)):
+            return False
+    return True
+
+
+def instance_can_mutate(data, mode):
+    """
+    Whether evaluating the instance in the given mode ("gold" or "pred") can
+    change its database: through preprocess, predicted, solution or clean-up
+    SQL, or through SQL issued by its test cases.
+    """
+    fields = ["preprocess_sql", "sol_sql", "clean_up_sql"]
+    if mode == "pred":
+        fields.append("pred_sqls")
+    if any(statement_can_mutate(sql) for field in fields for sql in split_field(data, field)):
+        return True
+    return any(test_case_can_mutate(code) for code in data.get("test_cases", []))
+
+
+def database_fingerprint(conn):
+    """
+    (rows changed by conn, schema cookie, data version) of an open connection.
+    Any write through conn or another connection changes the fingerprint.
+    """
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    return conn.total_changes, schema_version, data_version
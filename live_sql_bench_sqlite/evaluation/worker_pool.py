@@ -0,0 +1,288 @@
+# worker_pool.py
+"""
+Persistent worker processes for the SQLite evaluation wrapper.
+
+Each worker imports single_instance_eval_sqlite once and calls
+evaluate_instance directly for every instance it receives over a pipe, instead
+of paying interpreter startup, imports and temp-file I/O per instance.
+A worker that crashes or misses the per-instance deadline is killed and
+replaced, so one bad instance cannot affect the next; connections an instance
+leaves open are closed by evaluate_instance before its database is reset.
+"""
+import argparse
+import collections
+import multiprocessing as mp
+import os
+import queue
+
+from db_utils import (
+    load_memory_database,
+    reset_and_restore_database,
+    restore_memory_database,
+)
+from logger import configure_logger, NullLogger
+from sql_classifier import database_fingerprint, instance_can_mutate
+
+
+def failed_result(instance_data, instance_id, error_message, timeout_error=False):
+    return {
+        "instance_id": instance_id,
+        "status": "failed",
+        "error_message": error_message,
+        "total_test_cases": len(instance_data.get("test_cases", [])),
+        "passed_test_cases": 0,
+        "failed_test_cases": [],
+        "evaluation_phase_execution_error": not timeout_error,
+        "evaluation_phase_timeout_error": timeout_error,
+        "evaluation_phase_assertion_error": False,
+    }
+
+
+class MemoryDatabases:
+    """
+    In-memory templates and working copies of the databases a worker has used,
+    keyed by template path; the least recently used ones are dropped beyond limit.
+    """
+
+    def __init__(self, limit=4):
+        self.limit = limit
+        self.databases = collections.OrderedDict()
+
+    def working_connection(self, template_path):
+        if template_path in self.databases:
+            self.databases.move_to_end(template_path)
+        else:
+            self.databases[template_path] = load_memory_database(template_path)
+            while len(self.databases) > self.limit:
+                _, (template_conn, working_conn) = self.databases.popitem(last=False)
+                template_conn.close()
+                working_conn.close()
+        return self.databases[template_path][1]
+
+    def restore(self, template_path):
+        template_conn, working_conn = self.databases[template_path]
+        restore_memory_database(template_conn, working_conn)
+
+    def evaluate(self, evaluate_instance, instance_data, args, logger, template_path):
+        """
+        Run evaluate_instance on the in-memory copy of template_path and restore
+        the copy afterwards, unless the instance is read-only (see evaluate_instance).
+        """
+        working_conn = self.working_connection(template_path)
+        read_only = args.read_only_reset != "always" and not instance_can_mutate(
+            instance_data, args.mode
+        )
+        fingerprint = None
+        if read_only and args.read_only_reset == "verify":
+            fingerprint = database_fingerprint(working_conn)
+        try:
+            return evaluate_instance(instance_data, args, logger, db_connection=working_conn)
+        finally:
+            if not read_only or (
+                fingerprint is not None and database_fingerprint(working_conn) != fingerprint
+            ):
+                self.restore(template_path)
+
+
+def worker_main(conn, mode, sandbox="false", memory_limit=4, read_only_reset="verify"):
+    """
+    Worker loop: receive (instance_data, db_path, log_file_path, in_memory),
+    evaluate it and send back the result dict; None stops the worker.
+
+    in_memory=False: db_path is a leased ephemeral copy, evaluated as is.
+    in_memory=True: db_path is a template, which the worker loads into memory
+    once (keeping at most memory_limit databases) and the instance runs against
+    an in-memory working copy. The template path is never handed to the
+    instance: its db_path is ":memory:", so a test case that connects to
+    db_path itself gets an empty database rather than the template.
+    """
+    from single_instance_eval_sqlite import evaluate_instance
+
+    args = argparse.Namespace(mode=mode, sandbox=sandbox, read_only_reset=read_only_reset)
+    memory_databases = MemoryDatabases(memory_limit)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        instance_data, db_path, log_file_path, in_memory = message
+        # evaluate_instance reads the ephemeral database path from the environment
+        if in_memory:
+            os.environ.pop("EPHEMERAL_DB_PATH", None)
+        else:
+            os.environ["EPHEMERAL_DB_PATH"] = db_path
+        logger = configure_logger(log_file_path) if log_file_path else NullLogger()
+        try:
+            if in_memory:
+                result = memory_databases.evaluate(
+                    evaluate_instance, instance_data, args, logger, db_path
+                )
+            else:
+                result = evaluate_instance(instance_data, args, logger)
+        finally:
+            for handler in list(getattr(logger, "handlers", [])):
+                handler.close()
+                logger.removeHandler(handler)
+        conn.send(result)
+
+
+class InstanceWorker:
+    """
+    One worker process and the parent end of its pipe.
+    """
+
+    def __init__(self, context, mode, sandbox="false", memory_limit=4, read_only_reset="verify"):
+        self.context = context
+        self.mode = mode
+        self.sandbox = sandbox
+        self.memory_limit = memory_limit
+        self.read_only_reset = read_only_reset
+        self.process = None
+        self.conn = None
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=worker_main,
+            args=(child_conn, self.mode, self.sandbox, self.memory_limit, self.read_only_reset),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        self.kill()
+
+
+class WorkerPool:
+    """
+    num_workers persistent evaluation workers shared by the wrapper threads.
+
+    mode, sandbox, read_only_reset: passed to evaluate_instance as args.
+    timeout: per-instance deadline in seconds.
+    memory_limit: the most databases a worker keeps in memory for instances
+        evaluated with in_memory=True (see worker_main).
+    """
+
+    def __init__(
+        self,
+        num_workers,
+        mode="gold",
+        timeout=180,
+        logger=None,
+        sandbox="false",
+        memory_limit=4,
+        read_only_reset="verify",
+    ):
+        self.timeout = timeout
+        self.logger = logger or NullLogger()
+        # spawn: workers are also restarted from wrapper threads, where fork is unsafe
+        context = mp.get_context("spawn")
+        self.workers = [
+            InstanceWorker(context, mode, sandbox, memory_limit, read_only_reset)
+            for _ in range(num_workers)
+        ]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def acquire_worker(self):
+        """
+        Reserve an idle worker for the caller, e.g. to keep evaluating instances
+        of one database on it; pass it to evaluate() and give it back with
+        release_worker().
+        """
+        return self.idle.get()
+
+    def release_worker(self, worker):
+        self.idle.put(worker)
+
+    def evaluate(
+        self,
+        instance_data,
+        instance_id,
+        ephemeral_db_path,
+        log_file_path=None,
+        worker=None,
+        in_memory=False,
+    ):
+        """
+        Evaluate an instance on ephemeral_db_path, or with in_memory=True on an
+        in-memory copy of the template at ephemeral_db_path (see worker_main).
+        """
+        if worker is not None:
+            return self._evaluate(
+                worker, instance_data, instance_id, ephemeral_db_path, log_file_path, in_memory
+            )
+        worker = self.acquire_worker()
+        try:
+            return self._evaluate(
+                worker, instance_data, instance_id, ephemeral_db_path, log_file_path, in_memory
+            )
+        finally:
+            self.release_worker(worker)
+
+    def _evaluate(
+        self, worker, instance_data, instance_id, ephemeral_db_path, log_file_path, in_memory
+    ):
+        self.logger.info(
+            f"Starting instance {instance_id} with DB: {ephemeral_db_path}"
+            + (" (in memory)" if in_memory else "")
+        )
+        try:
+            worker.conn.send((instance_data, ephemeral_db_path, log_file_path, in_memory))
+            if not worker.conn.poll(self.timeout):
+                self.logger.error(
+                    f"Instance {instance_id} timed out after {self.timeout} seconds"
+                )
+                self._replace(worker, ephemeral_db_path, in_memory)
+                return failed_result(
+                    instance_data,
+                    instance_id,
+                    f"Instance timed out after {self.timeout} seconds",
+                    timeout_error=True,
+                )
+            result = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            self.logger.error(
+                f"Worker for instance {instance_id} died "
+                f"(exit code {worker.process.exitcode}): {e}"
+            )
+            self._replace(worker, ephemeral_db_path, in_memory)
+            return failed_result(
+                instance_data, instance_id, "Failed to evaluate instance (worker crashed)"
+            )
+        result["instance_id"] = instance_id
+        self.logger.info(f"Instance {instance_id} completed successfully")
+        return result
+
+    def _replace(self, worker, ephemeral_db_path, in_memory=False):
+        worker.restart()
+        if in_memory:
+            # the in-memory copies died with the worker; the instance never had
+            # the template's path, and the worker only opens it read-only
+            return
+        # the killed worker never reached evaluate_instance's own reset
+        try:
+            reset_and_restore_database(ephemeral_db_path, "123123", self.logger)
+        except Exception as e:
+            self.logger.error(f"Error during database reset: {e}")
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
@@ -6,11 +6,11 @@ Fixed threading and queue management issues
 """
 
 import argparse
+import contextlib
 import json
 import os
 import sys
 import subprocess
-import tempfile
 import time
 import gc
 import concurrent.futures
@@ -19,30 +19,29 @@ from datetime import datetime
 from tqdm import tqdm
 from logger import configure_logger
 from utils import load_jsonl, save_report_and_status
-from db_utils import create_ephemeral_db_copies, drop_ephemeral_dbs
+from db_utils import drop_ephemeral_dbs
+from affinity_scheduler import AffinityScheduler
+from ephemeral_pool import EphemeralDbPool, LeaseTimeout
+from framing import decode_frame, encode_frame
+from sql_classifier import test_case_opens_connection
+from worker_pool import WorkerPool, failed_result
 
 
 def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, logger):
     """Run a single evaluation instance in a separate process"""
-    
-    # Create temporary input file
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".jsonl", delete=False) as tmp:
-        tmp_input = tmp.name
-        json.dump(instance_data, tmp)
-
-    # Create temporary output file
-    tmp_output = tempfile.NamedTemporaryFile(suffix=".json", delete=False).name
 
     base_output_folder = os.path.splitext(args.jsonl_file)[0]
     log_file_path = f"{base_output_folder}_instance_{instance_id}.log"
 
-    # Build command to run single instance evaluation script
+    # Build command to run single instance evaluation script; the instance is
+    # sent on stdin and the result read from stdout as length-prefixed frames
     cmd = [
         "python3",
         "./single_instance_eval_sqlite.py",
-        "--jsonl_file", tmp_input,
-        "--output_file", tmp_output,
+        "--ipc", "stdio",
         "--mode", "gold",
+        "--sandbox", args.sandbox,
+        "--read_only_reset", args.read_only_reset,
         "--logging", "false",
         "--log_file", log_file_path,  # 添加这一行指定日志文件路径
     ]
@@ -54,14 +53,15 @@ def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, log
     # Log the start
     logger.info(f"Starting instance {instance_id} with DB: {ephemeral_db_path}")
 
+    result = None
     try:
         # Run the subprocess with timeout
         result = subprocess.run(
             cmd,
+            input=encode_frame(instance_data),
             capture_output=True,
-            text=True,
             check=False,
-            timeout=180,  # 3 minute timeout per instance
+            timeout=args.instance_timeout,
             env=env,
         )
         
@@ -70,33 +70,24 @@ def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, log
         if not success:
             logger.error(f"Instance {instance_id} failed with code {result.returncode}")
             if result.stderr:
-                logger.error(f"STDERR: {result.stderr[:300]}...")
+                logger.error(f"STDERR: {result.stderr[:300].decode(errors='replace')}...")
                 
     except subprocess.TimeoutExpired:
-        logger.error(f"Instance {instance_id} timed out after 180 seconds")
+        logger.error(f"Instance {instance_id} timed out after {args.instance_timeout} seconds")
         success = False
     except Exception as e:
         logger.error(f"Exception running instance {instance_id}: {e}")
         success = False
 
     # Process results
-    if success and os.path.exists(tmp_output) and os.path.getsize(tmp_output) > 0:
+    if success and result.stdout:
         try:
-            with open(tmp_output, "r") as f:
-                evaluation_result = json.load(f)
-                evaluation_result["instance_id"] = instance_id
-                logger.info(f"Instance {instance_id} completed successfully")
-                return evaluation_result
+            evaluation_result = decode_frame(result.stdout)
+            evaluation_result["instance_id"] = instance_id
+            logger.info(f"Instance {instance_id} completed successfully")
+            return evaluation_result
         except Exception as e:
             logger.error(f"Error reading output for instance {instance_id}: {e}")
-    
-    # Clean up temporary files
-    try:
-        os.unlink(tmp_input)
-        if os.path.exists(tmp_output):
-            os.unlink(tmp_output)
-    except Exception as e:
-        logger.error(f"Error cleaning up temp files for {instance_id}: {e}")
 
     # Return failure result
     logger.error(f"Instance {instance_id} failed completely")
@@ -113,16 +104,114 @@ def run_single_instance(instance_data, instance_id, args, ephemeral_db_path, log
     }
 
 
-def process_instances_batch(instances_batch, ephemeral_db_paths, args, logger):
-    """Process a batch of instances using available ephemeral databases"""
+def runs_in_memory(instance_data, args):
+    """
+    Whether the instance runs against an in-memory copy: in memory mode, unless
+    a test case opens its own connection to db_path, which could not see the
+    in-memory database. Those instances run on a leased file copy instead.
+    """
+    if args.ephemeral_mode != "memory":
+        return False
+    return not any(
+        test_case_opens_connection(code) for code in instance_data.get("test_cases", [])
+    )
+
+
+@contextlib.contextmanager
+def instance_database(db_pool, db_name, instance_data, args):
+    """
+    (path, in_memory) for one instance: the template of an in-memory instance,
+    which is only read by the pool worker, or a leased ephemeral copy.
+    """
+    if runs_in_memory(instance_data, args):
+        yield db_pool.template_path(db_name), True
+    else:
+        with db_pool.lease(db_name, timeout=args.lease_timeout) as ephemeral_db_path:
+            yield ephemeral_db_path, False
+
+
+def run_instance(
+    instance_data,
+    instance_id,
+    ephemeral_db_path,
+    args,
+    logger,
+    worker_pool=None,
+    worker=None,
+    in_memory=False,
+):
+    """Evaluate one instance on the worker pool (optionally a reserved worker) or in a subprocess"""
+    if worker_pool is not None:
+        log_file_path = None
+        if args.logging == "true":
+            base_output_folder = os.path.splitext(args.jsonl_file)[0]
+            log_file_path = f"{base_output_folder}_instance_{instance_id}.log"
+        return worker_pool.evaluate(
+            instance_data, instance_id, ephemeral_db_path, log_file_path, worker, in_memory
+        )
+
+    result = run_single_instance(instance_data, instance_id, args, ephemeral_db_path, logger)
+    # Small delay to avoid overwhelming the system
+    time.sleep(0.1)
+    return result
+
+
+def process_instances_with_affinity(scheduler, db_pool, args, logger, worker_pool=None, on_result=None):
+    """
+    Take instances from the affinity scheduler until none are left, on one
+    reserved pool worker. Each instance leases its ephemeral database on its
+    own; without contention the pool hands the thread back the copy it just
+    released, and a waiting thread (e.g. one that stole from this group) gets
+    it next instead.
+    """
+    results = []
+    db_name = None
+    worker = worker_pool.acquire_worker() if worker_pool is not None else None
+    try:
+        while True:
+            item = scheduler.next_instance(db_name)
+            if item is None:
+                break
+            instance_data, instance_id = item
+            db_name = instance_data.get("selected_database", "unknown")
+
+            try:
+                if db_name not in db_pool:
+                    logger.error(f"No ephemeral database available for {db_name}")
+                    result = failed_result(
+                        instance_data, instance_id, f"No ephemeral database available for {db_name}"
+                    )
+                else:
+                    with instance_database(db_pool, db_name, instance_data, args) as (
+                        db_path,
+                        in_memory,
+                    ):
+                        result = run_instance(
+                            instance_data, instance_id, db_path, args, logger, worker_pool, worker, in_memory
+                        )
+            except LeaseTimeout as e:
+                logger.error(str(e))
+                result = failed_result(instance_data, instance_id, str(e), timeout_error=True)
+            except Exception as e:
+                logger.error(f"Error processing instance {instance_id}: {e}")
+                result = failed_result(instance_data, instance_id, f"Processing error: {e}")
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    finally:
+        if worker is not None:
+            worker_pool.release_worker(worker)
+
+    return results
+
+
+def process_instances_batch(instances_batch, db_pool, args, logger, worker_pool=None):
+    """Process a batch of instances, leasing an ephemeral database for each one"""
     results = []
     
-    for i, (instance_data, instance_id) in enumerate(instances_batch):
-        # Use round-robin assignment of ephemeral databases
+    for instance_data, instance_id in instances_batch:
         db_name = instance_data.get("selected_database", "unknown")
-        if db_name in ephemeral_db_paths and ephemeral_db_paths[db_name]:
-            ephemeral_db_path = ephemeral_db_paths[db_name][i % len(ephemeral_db_paths[db_name])]
-        else:
+        if db_name not in db_pool:
             logger.error(f"No ephemeral database available for {db_name}")
             results.append({
                 "instance_id": instance_id,
@@ -137,12 +226,16 @@ def process_instances_batch(instances_batch, ephemeral_db_paths, args, logger):
             })
             continue
         
-        # Run the instance
-        result = run_single_instance(instance_data, instance_id, args, ephemeral_db_path, logger)
+        # Check out an ephemeral database for this instance only and run it
+        try:
+            with instance_database(db_pool, db_name, instance_data, args) as (db_path, in_memory):
+                result = run_instance(
+                    instance_data, instance_id, db_path, args, logger, worker_pool, in_memory=in_memory
+                )
+        except LeaseTimeout as e:
+            logger.error(str(e))
+            result = failed_result(instance_data, instance_id, str(e), timeout_error=True)
         results.append(result)
-        
-        # Small delay to avoid overwhelming the system
-        time.sleep(0.1)
     
     return results
 
@@ -158,8 +251,54 @@ def main():
     parser.add_argument("--logging", type=str, default="false", help="Enable logging")
     parser.add_argument("--mode", choices=["gold", "pred"], default="pred", help="Mode")
     parser.add_argument("--batch_size", type=int, default=10, help="Batch size for processing")
+    parser.add_argument(
+        "--schedule", choices=["affinity", "batch"], default="affinity",
+        help="Group instances by database per thread (affinity) or process --batch_size batches in file order",
+    )
+    parser.add_argument("--db_root", type=str, default="./database", help="Root folder of the SQLite databases")
+    parser.add_argument(
+        "--executor", choices=["pool", "subprocess"], default="pool",
+        help="Evaluate instances in persistent worker processes or one subprocess per instance",
+    )
+    parser.add_argument("--instance_timeout", type=float, default=180, help="Per-instance timeout (seconds)")
+    parser.add_argument(
+        "--sandbox", type=str, default="false",
+        help="Undo each instance by rolling back a transaction instead of copying the template ('true' or 'false')",
+    )
+    parser.add_argument(
+        "--read_only_reset", choices=["always", "skip", "verify"], default="verify",
+        help="Reset the database after read-only instances always, only if its fingerprint changed "
+        "(verify, the default), or never (skip, trusting the static read-only check)",
+    )
+    parser.add_argument(
+        "--ephemeral_mode", choices=["file", "memory"], default="file",
+        help="Evaluate against file copies of each database or in-memory copies held by the pool workers "
+        "(instances whose test cases open their own connection still use file copies)",
+    )
+    parser.add_argument(
+        "--memory_db_limit", type=int, default=4,
+        help="In memory mode, the maximum number of databases each worker keeps loaded",
+    )
+    parser.add_argument(
+        "--initial_copies", type=int, default=0,
+        help="Ephemeral copies created up front per database (0: create them lazily on first lease)",
+    )
+    parser.add_argument(
+        "--max_copies", type=int, default=None,
+        help="Maximum ephemeral copies per database, created on demand under contention (default: num_threads)",
+    )
+    parser.add_argument(
+        "--grow_after", type=float, default=0.5,
+        help="Seconds to wait for a free ephemeral copy before creating another one",
+    )
+    parser.add_argument(
+        "--lease_timeout", type=float, default=None,
+        help="Seconds to wait for an ephemeral copy before failing the instance (default: forever)",
+    )
 
     args = parser.parse_args()
+    if args.ephemeral_mode == "memory" and args.executor != "pool":
+        parser.error("--ephemeral_mode memory requires --executor pool")
 
     # Load and process data
     print(f"Loading data from {args.jsonl_file}...")
@@ -202,13 +341,17 @@ def main():
     logger.info(f"Batch size: {args.batch_size}")
     logger.info(f"Databases: {sorted(all_db_names)}")
 
-    # Create ephemeral database copies
+    # Create ephemeral database copies; in memory mode the pool workers load
+    # each template into memory, and copies are only made (lazily) for
+    # instances whose test cases open their own connection
     print("Creating ephemeral database copies...")
     try:
-        ephemeral_db_pool_dict = create_ephemeral_db_copies(
-            base_db_names=all_db_names,
-            num_copies=args.num_threads,
-            pg_password="123123",
+        db_pool = EphemeralDbPool(
+            all_db_names,
+            db_root=args.db_root,
+            initial_copies=args.initial_copies,
+            max_copies=args.max_copies or args.num_threads,
+            grow_after=args.grow_after,
             logger=logger,
         )
         print("✓ Ephemeral database copies created")
@@ -225,22 +368,54 @@ def main():
 
     # Split instances into batches
     batches = []
-    for i in range(0, len(instances_with_ids), args.batch_size):
-        batch = instances_with_ids[i:i + args.batch_size]
-        batches.append(batch)
-
-    print(f"Split {final_count} instances into {len(batches)} batches")
+    scheduler = None
+    if args.schedule == "affinity":
+        scheduler = AffinityScheduler(instances_with_ids)
+        print(f"Scheduling {final_count} instances by database")
+    else:
+        for i in range(0, len(instances_with_ids), args.batch_size):
+            batch = instances_with_ids[i:i + args.batch_size]
+            batches.append(batch)
+
+        print(f"Split {final_count} instances into {len(batches)} batches")
+
+    # Start the persistent workers before any wrapper thread exists
+    worker_pool = None
+    if args.executor == "pool":
+        # same mode as the subprocess command line in run_single_instance
+        worker_pool = WorkerPool(
+            args.num_threads,
+            mode="gold",
+            timeout=args.instance_timeout,
+            logger=logger,
+            sandbox=args.sandbox,
+            read_only_reset=args.read_only_reset,
+            memory_limit=args.memory_db_limit,
+        )
 
     # Process batches
     all_results = []
     
     with tqdm(total=final_count, desc="Processing instances", unit="instance") as pbar:
-        
-        if args.num_threads == 1:
+
+        if scheduler is not None:
+            # Each thread works through whole database groups, stealing when it runs dry
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+                futures = [
+                    executor.submit(
+                        process_instances_with_affinity,
+                        scheduler, db_pool, args, logger, worker_pool, lambda result: pbar.update(1),
+                    )
+                    for _ in range(args.num_threads)
+                ]
+                for future in concurrent.futures.as_completed(futures):
+                    all_results.extend(future.result())
+
+        elif args.num_threads == 1:
             # Single-threaded processing
             for batch_idx, batch in enumerate(batches):
                 logger.info(f"Processing batch {batch_idx + 1}/{len(batches)}")
-                batch_results = process_instances_batch(batch, ephemeral_db_pool_dict, args, logger)
+                batch_results = process_instances_batch(batch, db_pool, args, logger, worker_pool)
                 all_results.extend(batch_results)
                 pbar.update(len(batch))
                 
@@ -253,7 +428,7 @@ def main():
                 # Submit all batches
                 future_to_batch = {}
                 for batch_idx, batch in enumerate(batches):
-                    future = executor.submit(process_instances_batch, batch, ephemeral_db_pool_dict, args, logger)
+                    future = executor.submit(process_instances_batch, batch, db_pool, args, logger, worker_pool)
                     future_to_batch[future] = batch_idx
                 
                 # Process completed batches
@@ -286,6 +461,15 @@ def main():
                     # Force garbage collection
                     gc.collect()
 
+    if worker_pool is not None:
+        worker_pool.close()
+
+    if scheduler is not None:
+        print(scheduler.format_summary())
+        logger.info(scheduler.format_summary())
+    print(db_pool.format_summary())
+    logger.info(db_pool.format_summary())
+
     # Sort results by instance_id to maintain order
     all_results.sort(key=lambda x: x["instance_id"])
 
@@ -345,7 +529,7 @@ def main():
     # Cleanup
     print("\nCleaning up ephemeral databases...")
     try:
-        drop_ephemeral_dbs(ephemeral_db_pool_dict, "123123", logger)
+        drop_ephemeral_dbs(db_pool.all_copies(), "123123", logger)
         print("✓ Cleanup completed")
     except Exception as e:
         print(f"✗ Cleanup error: {e}")
@@ -13,6 +13,13 @@ engine='gpt-4-turbo'
 # Choose the number of threads to run in parallel, 1 for single thread
 num_threads=3
 
+# Use the asyncio engine instead of threads: up to max_in_flight concurrent requests,
+# throttled by requests/tokens per minute (0 means unlimited)
+async_requests='False'
+max_in_flight=256
+rpm=0
+tpm=0
+
 # Choose the SQL dialect to run, e.g. SQLite, MySQL, PostgreSQL
 # PLEASE NOTE: You have to setup the database information in table_schema.py 
 # if you want to run the evaluation script using MySQL or PostgreSQL
@@ -25,4 +32,5 @@ data_kg_output_path='./exp_result/turbo_output_kg/'
 echo "generate $engine batch, run in $num_threads threads, with knowledge: $use_knowledge, with chain of thought: $cot"
 python3 -u ./src/gpt_request.py --db_root_path ${db_root_path} --api_key ${YOUR_API_KEY} --mode ${mode} \
 --engine ${engine} --eval_path ${eval_path} --data_output_path ${data_kg_output_path} --use_knowledge ${use_knowledge} \
---chain_of_thought ${cot} --num_process ${num_threads} --sql_dialect ${sql_dialect}
\ No newline at end of file
+--chain_of_thought ${cot} --num_process ${num_threads} --sql_dialect ${sql_dialect} \
+--async_requests ${async_requests} --max_in_flight ${max_in_flight} --rpm ${rpm} --tpm ${tpm}
\ No newline at end of file
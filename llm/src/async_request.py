@@ -0,0 +1,248 @@
+"""
+Asyncio request engine for gpt_request.py.
+
+Requests are throttled by requests-per-minute and tokens-per-minute token buckets
+instead of fixed sleeps, retried with exponential backoff and full jitter (honoring
+Retry-After), and hundreds of them can be in flight at once.
+"""
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from openai import AsyncAzureOpenAI
+from tqdm import tqdm
+
+
+# client errors that will fail the same way on every retry
+NON_RETRYABLE_STATUS = {400, 401, 403, 404, 422}
+
+
+class TokenBucket:
+    """
+    Refill rate_per_minute units per minute, holding at most capacity units.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # a single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limits; 0 disables a limit.
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+
+    async def acquire(self, num_tokens):
+        if self.request_bucket:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket:
+            await self.token_bucket.acquire(num_tokens)
+
+
+def estimate_tokens(prompt, max_tokens):
+    # ~4 characters per prompt token, plus the completion budget
+    return len(prompt) // 4 + max_tokens
+
+
+def retry_after_seconds(error):
+    """
+    Read the server-requested delay from Retry-After(-ms) headers, if any.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+def is_retryable(error):
+    return getattr(error, "status_code", None) not in NON_RETRYABLE_STATUS
+
+
+def init_async_client(api_key, api_version, engine, api_base):
+    """
+    Initialize the AsyncAzureOpenAI client; retries are handled by connect_gpt_async.
+    """
+    return AsyncAzureOpenAI(
+        api_key=api_key,
+        api_version=api_version,
+        base_url=f"{api_base}/openai/deployments/{engine}",
+        max_retries=0,
+    )
+
+
+async def connect_gpt_async(
+    engine,
+    prompt,
+    max_tokens,
+    temperature,
+    stop,
+    client,
+    limiter,
+    max_retries=10,
+    base_delay=1.0,
+    max_delay=60.0,
+    metrics=None,
+):
+    """
+    Async counterpart of connect_gpt; returns the same result types and
+    records to metrics the same way.
+    """
+    start = time.time()
+    latency = None
+    error_class = None
+    for attempt in range(max_retries):
+        await limiter.acquire(estimate_tokens(prompt, max_tokens))
+        attempt_start = time.monotonic()
+        try:
+            if engine == "gpt-35-turbo-instruct":
+                result = await client.completions.create(
+                    model="gpt-3.5-turbo-instruct",
+                    prompt=prompt,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    stop=stop,
+                )
+                result = result.choices[0].text
+            else:
+                messages = [
+                    {"role": "user", "content": prompt},
+                ]
+                result = await client.chat.completions.create(
+                    model=engine,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stop=stop,
+                )
+            latency = time.monotonic() - attempt_start
+            break
+        except Exception as e:
+            result = "error:{}".format(e)
+            error_class = type(e).__name__
+            print(result)
+            if not is_retryable(e) or attempt == max_retries - 1:
+                break
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = backoff_delay(attempt, base_delay, max_delay)
+            await asyncio.sleep(delay)
+    if metrics:
+        metrics.record(engine, start, time.time(), latency, attempt + 1, result, error_class)
+    return result
+
+
+async def run_requests_async(
+    tasks,
+    engine,
+    client,
+    post_process,
+    max_tokens,
+    temperature,
+    stop,
+    max_in_flight=256,
+    rpm=0,
+    tpm=0,
+    response_cache=None,
+    on_result=None,
+    usage_stats=None,
+    metrics=None,
+    total=None,
+):
+    """
+    Send every (prompt, db_path, question, i) task with at most max_in_flight
+    concurrent requests and return [(sql, i), ...] in completion order.
+    tasks may be a lazy iterator; it is only advanced when a slot frees up.
+    on_result(sql, i) is called as soon as each question completes.
+    """
+    limiter = RateLimiter(rpm, tpm)
+
+    async def run_one(prompt, db_path, question, i):
+        request = (engine, prompt, temperature, max_tokens, stop)
+        response = response_cache.get(*request) if response_cache else None
+        if response is None:
+            response = await connect_gpt_async(
+                engine,
+                prompt,
+                max_tokens,
+                temperature,
+                stop,
+                client,
+                limiter,
+                metrics=metrics,
+            )
+            if usage_stats:
+                usage_stats.record(response)
+            if response_cache:
+                response_cache.put(*request, response)
+        sql = post_process(response, db_path)
+        print(f"Processed {i}th question: {question}")
+        return sql, i
+
+    responses = []
+
+    def collect(futures):
+        for future in futures:
+            result = future.result()
+            responses.append(result)
+            if on_result:
+                on_result(*result)
+            pbar.update(1)
+
+    pending = set()
+    with tqdm(total=total) as pbar:
+        for task in tasks:
+            if len(pending) >= max_in_flight:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                collect(done)
+            pending.add(asyncio.ensure_future(run_one(*task)))
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            collect(done)
+    await client.close()
+    return responses
@@ -0,0 +1,154 @@
+"""
+Offline batch-API mode for gpt_request.py.
+
+All prompts are serialized into one JSONL batch input file, uploaded through
+the files API and submitted as a batch. The batch is polled until it finishes
+and its results are mapped back to questions by custom_id. Batches trade
+latency (up to the completion window) for throughput and cost.
+"""
+import json
+import time
+
+from openai import AzureOpenAI
+from tqdm import tqdm
+
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def init_batch_client(api_key, api_version, api_base):
+    """
+    Files and batches live at the resource level, not under a deployment.
+    """
+    return AzureOpenAI(
+        api_key=api_key, api_version=api_version, base_url=f"{api_base}/openai"
+    )
+
+
+def batch_endpoint(engine):
+    return "/completions" if engine == "gpt-35-turbo-instruct" else "/chat/completions"
+
+
+def batch_request_body(engine, prompt, max_tokens, temperature, stop):
+    """
+    The same request connect_gpt sends, as a batch request body.
+    """
+    if engine == "gpt-35-turbo-instruct":
+        return {
+            "model": "gpt-3.5-turbo-instruct",
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stop": stop,
+        }
+    return {
+        "model": engine,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "stop": stop,
+    }
+
+
+def write_batch_input(tasks, path, engine, max_tokens, temperature, stop):
+    """
+    Write one batch request per (prompt, db_path, question, i) task to path and
+    return {custom_id: (db_path, i)}.
+    """
+    id_map = {}
+    with open(path, "w") as f:
+        for prompt, db_path, question, i in tasks:
+            custom_id = f"question-{i}"
+            request = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": batch_endpoint(engine),
+                "body": batch_request_body(engine, prompt, max_tokens, temperature, stop),
+            }
+            f.write(json.dumps(request) + "\n")
+            id_map[custom_id] = (db_path, i)
+    return id_map
+
+
+def submit_batch(client, input_path, engine, completion_window="24h"):
+    with open(input_path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=batch_endpoint(engine),
+        completion_window=completion_window,
+    )
+
+
+def wait_for_batch(client, batch_id, poll_interval=30):
+    with tqdm(desc=f"batch {batch_id}") as pbar:
+        while True:
+            batch = client.batches.retrieve(batch_id)
+            counts = batch.request_counts
+            if counts is not None:
+                pbar.total = counts.total
+                pbar.n = counts.completed + counts.failed
+                pbar.set_postfix(status=batch.status)
+                pbar.refresh()
+            if batch.status in TERMINAL_STATUSES:
+                return batch
+            time.sleep(poll_interval)
+
+
+def read_batch_file(client, file_id):
+    if not file_id:
+        return []
+    content = client.files.content(file_id).text
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def response_text(line):
+    """
+    The completion text of one batch output line, or an "error:..." string like
+    connect_gpt returns when a request fails.
+    """
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        return "error:{}".format(line.get("error") or response.get("body"))
+    choice = response["body"]["choices"][0]
+    return choice["message"]["content"] if "message" in choice else choice["text"]
+
+
+def run_batch(
+    client,
+    tasks,
+    engine,
+    post_process,
+    max_tokens,
+    temperature,
+    stop,
+    input_path,
+    poll_interval=30,
+    on_result=None,
+):
+    """
+    Submit all tasks as one batch and return [(sql, i), ...] once it finishes.
+    Questions missing from the batch output get an "error:..." response.
+    """
+    id_map = write_batch_input(tasks, input_path, engine, max_tokens, temperature, stop)
+    if not id_map:
+        return []
+    batch = submit_batch(client, input_path, engine)
+    print(f"submitted batch {batch.id} with {len(id_map)} requests")
+    batch = wait_for_batch(client, batch.id, poll_interval)
+    print(f"batch {batch.id} finished with status {batch.status}")
+
+    texts = {}
+    for line in read_batch_file(client, batch.error_file_id) + read_batch_file(
+        client, batch.output_file_id
+    ):
+        texts[line["custom_id"]] = response_text(line)
+
+    responses = []
+    for custom_id, (db_path, i) in id_map.items():
+        response = texts.get(custom_id, f"error:batch {batch.status}, no result")
+        sql = post_process(response, db_path)
+        responses.append((sql, i))
+        if on_result:
+            on_result(sql, i)
+    return responses
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Offline per-column value statistics for BIRD databases.
+
+Each database is scanned offline, tables in parallel: one aggregate query per
+table covers every column, plus one GROUP BY query per column for its most
+frequent values. The statistics are saved in a compact sidecar file next to
+the database, e.g. financial/financial_column_stats.json.
+Schema prompts then load the sidecar instead of querying example rows per question.
+"""
+import argparse
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+
+from tqdm import tqdm
+
+
+STATS_VERSION = 1
+
+_column_stats_cache = {}
+
+
+def column_stats_path(db_path):
+    return os.path.splitext(db_path)[0] + "_column_stats.json"
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def compact_value(value, max_value_len=50):
+    if isinstance(value, bytes):
+        return "<blob>"
+    if isinstance(value, str) and len(value) > max_value_len:
+        return value[:max_value_len] + "..."
+    return value
+
+
+def scan_table_stats(db_path, table, top_k=5, max_value_len=50):
+    """
+    Compute row count, distinct count, min/max, null ratio and the top-k most
+    frequent values of every column of one table: the aggregates in a single
+    query, the top-k values with one GROUP BY query per column.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    quoted_table = quote_identifier(table)
+    cursor.execute(f"PRAGMA table_info({quoted_table})")
+    columns = [row[1] for row in cursor.fetchall()]
+
+    aggregates = ", ".join(
+        f"COUNT(DISTINCT {q}), MIN({q}), MAX({q}), SUM({q} IS NULL)"
+        for q in map(quote_identifier, columns)
+    )
+    cursor.execute(f"SELECT COUNT(*), {aggregates} FROM {quoted_table}")
+    row = cursor.fetchone()
+    num_rows = row[0]
+
+    columns_stats = {}
+    for j, column in enumerate(columns):
+        distinct, min_value, max_value, nulls = row[1 + 4 * j : 5 + 4 * j]
+        quoted_column = quote_identifier(column)
+        cursor.execute(
+            f"SELECT {quoted_column}, COUNT(*) AS freq FROM {quoted_table} "
+            f"WHERE {quoted_column} IS NOT NULL "
+            f"GROUP BY {quoted_column} ORDER BY freq DESC LIMIT {top_k}"
+        )
+        top_values = [
+            [compact_value(value, max_value_len), freq]
+            for value, freq in cursor.fetchall()
+        ]
+        columns_stats[column] = {
+            "distinct": distinct,
+            "min": compact_value(min_value, max_value_len),
+            "max": compact_value(max_value, max_value_len),
+            "null_ratio": round((nulls or 0) / num_rows, 4) if num_rows else 0.0,
+            "top_k": top_values,
+        }
+    conn.close()
+    return {"num_rows": num_rows, "columns": columns_stats}
+
+
+def build_column_stats(db_path, top_k=5, num_threads=8, max_value_len=50):
+    """
+    Scan every table of db_path in parallel and write the sidecar file.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    tables = [
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+    conn.close()
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        future_to_table = {
+            executor.submit(scan_table_stats, db_path, table, top_k, max_value_len): table
+            for table in tables
+        }
+        tables_stats = {}
+        for future in concurrent.futures.as_completed(future_to_table):
+            tables_stats[future_to_table[future]] = future.result()
+
+    stat = os.stat(db_path)
+    stats = {
+        "version": STATS_VERSION,
+        "db_mtime": stat.st_mtime_ns,
+        "db_size": stat.st_size,
+        "tables": {table: tables_stats[table] for table in tables},
+    }
+    with open(column_stats_path(db_path), "w") as f:
+        json.dump(stats, f, ensure_ascii=False, separators=(",", ":"))
+    return stats
+
+
+def load_column_stats(db_path):
+    """
+    Load (and memoize) the sidecar of db_path; None if it has not been built,
+    or if it is stale: built by another STATS_VERSION or from a database whose
+    mtime/size differ from db_path's now (a warning is printed once).
+    """
+    sidecar = column_stats_path(db_path)
+    try:
+        mtime = os.stat(sidecar).st_mtime_ns
+        db_stat = os.stat(db_path)
+    except OSError:
+        return None
+    key = (mtime, db_stat.st_mtime_ns, db_stat.st_size)
+    cached = _column_stats_cache.get(sidecar)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(sidecar, "r") as f:
+        stats = json.load(f)
+    if (
+        stats.get("version") != STATS_VERSION
+        or stats.get("db_mtime") != db_stat.st_mtime_ns
+        or stats.get("db_size") != db_stat.st_size
+    ):
+        print(
+            "Warning: ignoring stale column statistics {} (database changed since "
+            "they were built); rerun column_stats.py".format(sidecar)
+        )
+        stats = None
+    _column_stats_cache[sidecar] = (key, stats)
+    return stats
+
+
+def format_column_stats(table, table_stats):
+    lines = [
+        "/* column value statistics of {} ({} rows):".format(
+            table, table_stats["num_rows"]
+        )
+    ]
+    for column, stats in table_stats["columns"].items():
+        parts = ["{} distinct".format(stats["distinct"])]
+        if stats["distinct"] and stats["distinct"] <= len(stats["top_k"]):
+            parts.append(
+                "values: "
+                + ", ".join("{!r} ({})".format(v, freq) for v, freq in stats["top_k"])
+            )
+        else:
+            parts.append("range: [{!r}, {!r}]".format(stats["min"], stats["max"]))
+            # unique columns (ids, measurements) have no informative top values
+            if stats["top_k"] and stats["top_k"][0][1] > 1:
+                parts.append(
+                    "most frequent: "
+                    + ", ".join("{!r} ({})".format(v, freq) for v, freq in stats["top_k"])
+                )
+        if stats["null_ratio"]:
+            parts.append("{:.1%} null".format(stats["null_ratio"]))
+        lines.append(" {}: {}".format(column, "; ".join(parts)))
+    lines.append("*/")
+    return "\n".join(lines)
+
+
+def add_column_stats(schemas, stats):
+    """
+    Append the statistics block of each table to its DDL in a {table: ddl} dict.
+    """
+    tables_stats = stats.get("tables", {})
+    return {
+        table: (
+            "{} \n {}".format(ddl, format_column_stats(table, tables_stats[table]))
+            if table in tables_stats
+            else ddl
+        )
+        for table, ddl in schemas.items()
+    }
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--db_root_path", type=str, required=True)
+    args_parser.add_argument("--top_k", type=int, default=5)
+    args_parser.add_argument("--num_threads", type=int, default=8)
+    args_parser.add_argument("--max_value_len", type=int, default=50)
+    args = args_parser.parse_args()
+
+    db_ids = sorted(
+        db_id
+        for db_id in os.listdir(args.db_root_path)
+        if os.path.exists(os.path.join(args.db_root_path, db_id, db_id + ".sqlite"))
+    )
+    for db_id in tqdm(db_ids):
+        db_path = os.path.join(args.db_root_path, db_id, db_id + ".sqlite")
+        build_column_stats(db_path, args.top_k, args.num_threads, args.max_value_len)
+    print("built column statistics for {} databases".format(len(db_ids)))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import json
 import os
 from openai import AzureOpenAI
@@ -8,7 +9,16 @@ import time
 from concurrent.futures import ThreadPoolExecutor
 import concurrent.futures
 
+from async_request import init_async_client, run_requests_async
+from batch_request import init_batch_client, run_batch
+from hedging import Hedger
+from prediction_journal import PredictionJournal
 from prompt import generate_combined_prompts_one
+from request_metrics import RequestMetrics
+from response_cache import ResponseCache, response_content
+from schema_pruning import PruningReport
+from table_schema import preload_schema_dicts
+from usage_stats import PrefixCacheStats
 
 
 """openai configure"""
@@ -21,13 +31,18 @@ def new_directory(path):
         os.makedirs(path)
 
 
-def connect_gpt(engine, prompt, max_tokens, temperature, stop, client):
+def connect_gpt(engine, prompt, max_tokens, temperature, stop, client, metrics=None):
     """
     Function to connect to the GPT API and get the response.
+    Latency, usage, attempts and outcome are recorded to metrics if given.
     """
     MAX_API_RETRY = 10
+    start = time.time()
+    latency = None
+    error_class = None
     for i in range(MAX_API_RETRY):
         time.sleep(2)
+        attempt_start = time.monotonic()
         try:
 
             if engine == "gpt-35-turbo-instruct":
@@ -50,11 +65,15 @@ def connect_gpt(engine, prompt, max_tokens, temperature, stop, client):
                     max_tokens=max_tokens,
                     stop=stop,
                 )
+            latency = time.monotonic() - attempt_start
             break
         except Exception as e:
             result = "error:{}".format(e)
+            error_class = type(e).__name__
             print(result)
             time.sleep(4)
+    if metrics:
+        metrics.record(engine, start, time.time(), latency, i + 1, result, error_class)
     return result
 
 
@@ -90,34 +109,127 @@ def generate_sql_file(sql_lst, output_path=None):
 
 def init_client(api_key, api_version, engine):
     """
-    Initialize the AzureOpenAI client for a worker.
+    Initialize the AzureOpenAI client for a worker; retries are handled by
+    connect_gpt, so that each one reaches the request metrics.
     """
     return AzureOpenAI(
         api_key=api_key,
         api_version=api_version,
         base_url=f"{api_base}/openai/deployments/{engine}",
+        max_retries=0,
     )
 
 
 def post_process_response(response, db_path):
-    sql = response if isinstance(response, str) else response.choices[0].message.content
+    sql = response_content(response)
     db_id = db_path.split("/")[-1].split(".sqlite")[0]
     sql = f"{sql}\t----- bird -----\t{db_id}"
     return sql
 
 
-def worker_function(question_data):
+MAX_TOKENS = 512
+TEMPERATURE = 0
+STOP_SEQUENCES = ["--", "\n\n", ";", "#"]
+
+
+def worker_function(
+    question_data,
+    response_cache=None,
+    usage_stats=None,
+    hedger=None,
+    hedge_target=None,
+    metrics=None,
+):
     """
     Function to process each question, set up the client,
     generate the prompt, and collect the GPT response.
+    With a hedger, slow requests are duplicated to hedge_target, an
+    (engine, client) pair that defaults to the primary deployment.
     """
     prompt, engine, client, db_path, question, i = question_data
-    response = connect_gpt(engine, prompt, 512, 0, ["--", "\n\n", ";", "#"], client)
+    request = (engine, prompt, TEMPERATURE, MAX_TOKENS, STOP_SEQUENCES)
+    response = response_cache.get(*request) if response_cache else None
+    if response is None:
+        if hedger:
+            hedge_engine, hedge_client = hedge_target or (engine, client)
+            response = hedger.call(
+                lambda: connect_gpt(
+                    engine,
+                    prompt,
+                    MAX_TOKENS,
+                    TEMPERATURE,
+                    STOP_SEQUENCES,
+                    client,
+                    metrics,
+                ),
+                lambda: connect_gpt(
+                    hedge_engine,
+                    prompt,
+                    MAX_TOKENS,
+                    TEMPERATURE,
+                    STOP_SEQUENCES,
+                    hedge_client,
+                    metrics,
+                ),
+            )
+        else:
+            response = connect_gpt(
+                engine,
+                prompt,
+                MAX_TOKENS,
+                TEMPERATURE,
+                STOP_SEQUENCES,
+                client,
+                metrics,
+            )
+        if usage_stats:
+            usage_stats.record(response)
+        if response_cache:
+            response_cache.put(*request, response)
     sql = post_process_response(response, db_path)
     print(f"Processed {i}th question: {question}")
     return sql, i
 
 
+def generate_prompt_tasks(
+    db_path_list,
+    question_list,
+    sql_dialect,
+    knowledge_list=None,
+    skip_indices=(),
+    group_by_db=False,
+    **prompt_kwargs,
+):
+    """
+    Lazily yield the (prompt, db_path, question, i) task of every question not
+    in skip_indices. prompt_kwargs are forwarded to generate_combined_prompts_one.
+    With group_by_db, questions are dispatched database by database (dataset
+    order within a database) so consecutive requests share their schema prefix.
+    """
+    if sql_dialect in ("MySQL", "PostgreSQL"):
+        # one information_schema round trip instead of one query per table and question
+        preload_schema_dicts(sql_dialect)
+
+    order = range(len(question_list))
+    if group_by_db:
+        order = sorted(order, key=lambda i: db_path_list[i])
+    for i in order:
+        if i in skip_indices:
+            continue
+        prompt = generate_combined_prompts_one(
+            db_path=db_path_list[i],
+            question=question_list[i],
+            sql_dialect=sql_dialect,
+            knowledge=knowledge_list[i] if knowledge_list else None,
+            **prompt_kwargs,
+        )
+        yield prompt, db_path_list[i], question_list[i], i
+
+
+def count_tasks(question_list, skip_indices=()):
+    return sum(1 for i in range(len(question_list)) if i not in skip_indices)
+
+
 def collect_response_from_gpt(
     db_path_list,
     question_list,
@@ -126,38 +238,170 @@ def collect_response_from_gpt(
     sql_dialect,
     num_threads=3,
     knowledge_list=None,
+    response_cache=None,
+    on_result=None,
+    skip_indices=(),
+    max_pending=None,
+    group_by_db=False,
+    usage_stats=None,
+    hedger=None,
+    hedge_engine=None,
+    metrics=None,
+    **prompt_kwargs,
 ):
     """
     Collect responses from GPT using multiple threads.
+    Prompts are built lazily and at most max_pending (default 2 * num_threads)
+    questions are queued at once. on_result(sql, i) is called as soon as each
+    question completes. With a hedger, slow requests are duplicated to
+    hedge_engine (default: the same deployment).
     """
     client = init_client(api_key, api_version, engine)
+    hedge_target = (
+        (hedge_engine, init_client(api_key, api_version, hedge_engine))
+        if hedger and hedge_engine
+        else None
+    )
+    max_pending = max_pending or 2 * num_threads
+
+    tasks = generate_prompt_tasks(
+        db_path_list,
+        question_list,
+        sql_dialect,
+        knowledge_list,
+        skip_indices,
+        group_by_db,
+        **prompt_kwargs,
+    )
+    responses = []
+
+    def collect(futures):
+        for future in futures:
+            result = future.result()
+            responses.append(result)
+            if on_result:
+                on_result(*result)
+            pbar.update(1)
+
+    pending = set()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor, tqdm(
+        total=count_tasks(question_list, skip_indices)
+    ) as pbar:
+        for prompt, db_path, question, i in tasks:
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                collect(done)
+            task = (prompt, engine, client, db_path, question, i)
+            pending.add(
+                executor.submit(
+                    worker_function,
+                    task,
+                    response_cache,
+                    usage_stats,
+                    hedger,
+                    hedge_target,
+                    metrics,
+                )
+            )
+        collect(concurrent.futures.as_completed(pending))
+    return responses
+
 
-    tasks = [
-        (
-            generate_combined_prompts_one(
-                db_path=db_path_list[i],
-                question=question_list[i],
-                sql_dialect=sql_dialect,
-                knowledge=knowledge_list[i],
-            ),
+def collect_response_from_gpt_async(
+    db_path_list,
+    question_list,
+    api_key,
+    engine,
+    sql_dialect,
+    knowledge_list=None,
+    max_in_flight=256,
+    rpm=0,
+    tpm=0,
+    response_cache=None,
+    on_result=None,
+    skip_indices=(),
+    group_by_db=False,
+    usage_stats=None,
+    metrics=None,
+    **prompt_kwargs,
+):
+    """
+    Collect responses from GPT with the asyncio engine, rate limited by
+    requests/tokens per minute instead of fixed sleeps.
+    """
+    client = init_async_client(api_key, api_version, engine, api_base)
+    tasks = generate_prompt_tasks(
+        db_path_list,
+        question_list,
+        sql_dialect,
+        knowledge_list,
+        skip_indices,
+        group_by_db,
+        **prompt_kwargs,
+    )
+    return asyncio.run(
+        run_requests_async(
+            tasks,
             engine,
             client,
-            db_path_list[i],
-            question_list[i],
-            i,
+            post_process_response,
+            MAX_TOKENS,
+            TEMPERATURE,
+            STOP_SEQUENCES,
+            max_in_flight=max_in_flight,
+            rpm=rpm,
+            tpm=tpm,
+            response_cache=response_cache,
+            on_result=on_result,
+            usage_stats=usage_stats,
+            metrics=metrics,
+            total=count_tasks(question_list, skip_indices),
         )
-        for i in range(len(question_list))
-    ]
-    responses = []
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        future_to_task = {
-            executor.submit(worker_function, task): task for task in tasks
-        }
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_task), total=len(tasks)
-        ):
-            responses.append(future.result())
-    return responses
+    )
+
+
+def collect_response_from_gpt_batch(
+    db_path_list,
+    question_list,
+    api_key,
+    engine,
+    sql_dialect,
+    batch_input_path,
+    knowledge_list=None,
+    poll_interval=30,
+    on_result=None,
+    skip_indices=(),
+    group_by_db=False,
+    **prompt_kwargs,
+):
+    """
+    Collect responses from GPT through the offline batch API: all prompts are
+    submitted as one batch, written to batch_input_path first.
+    """
+    client = init_batch_client(api_key, api_version, api_base)
+    tasks = generate_prompt_tasks(
+        db_path_list,
+        question_list,
+        sql_dialect,
+        knowledge_list,
+        skip_indices,
+        group_by_db,
+        **prompt_kwargs,
+    )
+    return run_batch(
+        client,
+        tasks,
+        engine,
+        post_process_response,
+        MAX_TOKENS,
+        TEMPERATURE,
+        STOP_SEQUENCES,
+        batch_input_path,
+        poll_interval=poll_interval,
+        on_result=on_result,
+    )
 
 
 if __name__ == "__main__":
@@ -175,7 +419,61 @@ if __name__ == "__main__":
     args_parser.add_argument("--chain_of_thought", type=str)
     args_parser.add_argument("--num_processes", type=int, default=3)
     args_parser.add_argument("--sql_dialect", type=str, default="SQLite")
+    args_parser.add_argument("--schema_cache_dir", type=str, default=None)
+    args_parser.add_argument("--column_stats", type=str, default="False")
+    args_parser.add_argument("--value_index_root", type=str, default=None)
+    args_parser.add_argument("--schema_top_k", type=int, default=0)
+    args_parser.add_argument("--pruning_report_path", type=str, default=None)
+    args_parser.add_argument("--api_base", type=str, default=api_base)
+    args_parser.add_argument("--async_requests", type=str, default="False")
+    args_parser.add_argument("--max_in_flight", type=int, default=256)
+    args_parser.add_argument("--rpm", type=int, default=0)
+    args_parser.add_argument("--tpm", type=int, default=0)
+    args_parser.add_argument("--response_cache_path", type=str, default=None)
+    args_parser.add_argument("--cache_ttl", type=float, default=0)
+    args_parser.add_argument("--bypass_cache", type=str, default="False")
+    args_parser.add_argument("--resume", type=str, default="False")
+    args_parser.add_argument(
+        "--prompt_layout", type=str, default="default", choices=["default", "prefix_stable"]
+    )
+    args_parser.add_argument(
+        "--dispatch_order", type=str, default="dataset", choices=["dataset", "db_grouped"]
+    )
+    args_parser.add_argument("--hedge_percentile", type=float, default=0)
+    args_parser.add_argument("--max_hedge_ratio", type=float, default=0.1)
+    args_parser.add_argument("--hedge_engine", type=str, default=None)
+    args_parser.add_argument("--metrics_path", type=str, default=None)
+    args_parser.add_argument("--batch_api", type=str, default="False")
+    args_parser.add_argument("--batch_poll_interval", type=float, default=30)
+    args_parser.add_argument("--ground_truth_path", type=str, default=None)
+    args_parser.add_argument("--diff_json_path", type=str, default=None)
+    args_parser.add_argument("--eval_num_cpus", type=int, default=4)
+    args_parser.add_argument("--meta_time_out", type=float, default=30.0)
+    args_parser.add_argument("--eval_metrics", type=str, default="EX,F1")
+    args_parser.add_argument("--eval_log_path", type=str, default=None)
     args = args_parser.parse_args()
+    if args.ground_truth_path and not args.diff_json_path:
+        # the streaming evaluator needs the difficulties for its breakdown
+        args_parser.error("--ground_truth_path requires --diff_json_path")
+    if args.schema_top_k and args.prompt_layout == "prefix_stable":
+        # a pruned schema differs per question, so there is no stable prefix
+        args_parser.error("--schema_top_k cannot be combined with --prompt_layout prefix_stable")
+    if args.schema_top_k and args.dispatch_order == "db_grouped":
+        print(
+            "Warning: --schema_top_k gives every question its own schema block, so "
+            "--dispatch_order db_grouped will get few provider prefix cache hits"
+        )
+    api_base = args.api_base
+    response_cache = (
+        ResponseCache(
+            args.response_cache_path,
+            ttl=args.cache_ttl or None,
+            bypass=args.bypass_cache == "True",
+        )
+        if args.response_cache_path
+        else None
+    )
+    pruning_report = PruningReport() if args.schema_top_k else None
 
     eval_data = json.load(open(args.eval_path, "r"))
 
@@ -184,25 +482,23 @@ if __name__ == "__main__":
     )
     assert len(question_list) == len(db_path_list) == len(knowledge_list)
 
-    if args.use_knowledge == "True":
-        responses = collect_response_from_gpt(
-            db_path_list,
-            question_list,
-            args.api_key,
-            args.engine,
-            args.sql_dialect,
-            args.num_processes,
-            knowledge_list,
-        )
-    else:
-        responses = collect_response_from_gpt(
-            db_path_list,
-            question_list,
-            args.api_key,
-            args.engine,
-            args.sql_dialect,
-            args.num_processes,
-        )
+    prompt_kwargs = dict(
+        schema_cache_dir=args.schema_cache_dir,
+        column_stats=args.column_stats == "True",
+        value_index_root=args.value_index_root,
+        schema_top_k=args.schema_top_k,
+        pruning_report=pruning_report,
+        prompt_layout=args.prompt_layout,
+    )
+    usage_stats = PrefixCacheStats()
+    metrics = RequestMetrics()
+    hedger = (
+        Hedger(args.hedge_percentile, args.max_hedge_ratio)
+        if args.hedge_percentile
+        else None
+    )
+    if args.use_knowledge != "True":
+        knowledge_list = None
 
     if args.chain_of_thought == "True":
         output_name = (
@@ -227,7 +523,120 @@ if __name__ == "__main__":
             + args.sql_dialect
             + ".json"
         )
-    generate_sql_file(sql_lst=responses, output_path=output_name)
+    journal_path = os.path.splitext(output_name)[0] + "_journal.jsonl"
+    journal = PredictionJournal(journal_path, resume=args.resume == "True")
+    if journal.done:
+        print(f"Resuming: {len(journal.done)} questions already in {journal_path}")
+
+    on_result = journal.append
+    evaluator = None
+    if args.ground_truth_path:
+        # score predictions while the remaining ones are still being generated
+        from streaming_eval import StreamingEvaluator
+
+        evaluator = StreamingEvaluator(
+            args.ground_truth_path,
+            args.db_root_path,
+            args.diff_json_path,
+            num_cpus=args.eval_num_cpus,
+            meta_time_out=args.meta_time_out,
+            sql_dialect=args.sql_dialect,
+            metrics=args.eval_metrics.split(","),
+        )
+        for i, sql in journal.done.items():
+            evaluator(sql, i)
+
+        def on_result(sql, i):
+            journal.append(sql, i)
+            evaluator(sql, i)
+
+    if args.batch_api == "True":
+        responses = collect_response_from_gpt_batch(
+            db_path_list,
+            question_list,
+            args.api_key,
+            args.engine,
+            args.sql_dialect,
+            os.path.splitext(output_name)[0] + "_batch_input.jsonl",
+            knowledge_list,
+            poll_interval=args.batch_poll_interval,
+            on_result=on_result,
+            skip_indices=set(journal.done),
+            group_by_db=args.dispatch_order == "db_grouped",
+            **prompt_kwargs,
+        )
+    elif args.async_requests == "True":
+        responses = collect_response_from_gpt_async(
+            db_path_list,
+            question_list,
+            args.api_key,
+            args.engine,
+            args.sql_dialect,
+            knowledge_list,
+            max_in_flight=args.max_in_flight,
+            rpm=args.rpm,
+            tpm=args.tpm,
+            response_cache=response_cache,
+            on_result=on_result,
+            skip_indices=set(journal.done),
+            group_by_db=args.dispatch_order == "db_grouped",
+            usage_stats=usage_stats,
+            metrics=metrics,
+            **prompt_kwargs,
+        )
+    else:
+        responses = collect_response_from_gpt(
+            db_path_list,
+            question_list,
+            args.api_key,
+            args.engine,
+            args.sql_dialect,
+            args.num_processes,
+            knowledge_list,
+            response_cache=response_cache,
+            on_result=on_result,
+            skip_indices=set(journal.done),
+            group_by_db=args.dispatch_order == "db_grouped",
+            usage_stats=usage_stats,
+            hedger=hedger,
+            hedge_engine=args.hedge_engine,
+            metrics=metrics,
+            **prompt_kwargs,
+        )
+    print(usage_stats.summary())
+    if metrics.records:
+        print(metrics.format_summary())
+        if args.metrics_path:
+            metrics.dump(args.metrics_path)
+    if hedger is not None:
+        print(hedger.summary())
+    if response_cache is not None:
+        print(
+            "response cache: {} hits, {} misses".format(
+                response_cache.hits, response_cache.misses
+            )
+        )
+        response_cache.close()
+
+    journal.close()
+    # the journal holds both resumed and newly collected predictions
+    generate_sql_file(sql_lst=journal.results(), output_path=output_name)
+
+    if evaluator is not None:
+        evaluator.finish(args.eval_log_path)
+
+    if pruning_report is not None:
+        summary = pruning_report.summary()
+        print(
+            "schema pruning saved {} of {} schema tokens ({:.1%}) over {} questions".format(
+                summary["saved_tokens"],
+                summary["full_schema_tokens"],
+                summary["saved_ratio"],
+                summary["questions"],
+            )
+        )
+        if args.pruning_report_path:
+            pruning_report.dump(args.pruning_report_path)
 
     print(
         "successfully collect results from {} for {} evaluation; SQL dialect {} Use knowledge: {}; Use COT: {}".format(
@@ -0,0 +1,125 @@
+"""
+Hedged requests for the threaded engine of gpt_request.py.
+
+If a request has not returned after a percentile of the latencies observed so
+far, a duplicate is sent (to the same or an alternate deployment) and whichever
+answer arrives first is used. Duplicates are capped at a fraction of all
+requests so a slow endpoint cannot double the spend.
+"""
+import collections
+import concurrent.futures
+import threading
+import time
+
+from response_cache import is_error_response
+
+
+class LatencyTracker:
+    """
+    Sliding window of request latencies (seconds).
+    """
+
+    def __init__(self, window=1000):
+        self.samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p, min_samples=1):
+        with self._lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def _run_in_thread(fn):
+    # a dedicated thread per attempt: a losing request cannot be cancelled and
+    # must not hold a slot of the caller's pool while it runs to completion
+    future = concurrent.futures.Future()
+
+    def target():
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+class Hedger:
+    """
+    percentile: hedge once a request is slower than this percentile of observed latency.
+    max_hedge_ratio: at most this fraction of requests may be duplicated.
+    min_samples: no hedging until this many latencies have been observed.
+    """
+
+    def __init__(self, percentile=95, max_hedge_ratio=0.1, min_samples=20):
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.latency = LatencyTracker()
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.hedges_skipped = 0
+        self._lock = threading.Lock()
+
+    def _timed(self, fn):
+        def call():
+            start = time.monotonic()
+            result = fn()
+            if not is_error_response(result):
+                self.latency.record(time.monotonic() - start)
+            return result
+
+        return call
+
+    def _reserve_hedge(self):
+        with self._lock:
+            if self.hedges_fired + 1 > self.max_hedge_ratio * self.requests:
+                self.hedges_skipped += 1
+                return False
+            self.hedges_fired += 1
+            return True
+
+    def call(self, primary, hedge):
+        """
+        Run primary(); if it is slower than the hedge threshold, also run hedge()
+        and return the first successful result.
+        """
+        with self._lock:
+            self.requests += 1
+        threshold = self.latency.percentile(self.percentile, self.min_samples)
+        primary_future = _run_in_thread(self._timed(primary))
+        if threshold is None:
+            return primary_future.result()
+        try:
+            return primary_future.result(timeout=threshold)
+        except concurrent.futures.TimeoutError:
+            pass
+        if not self._reserve_hedge():
+            return primary_future.result()
+
+        hedge_future = _run_in_thread(self._timed(hedge))
+        pending = {primary_future, hedge_future}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                result = future.result()
+                # an exhausted-retries error only wins if the other attempt fails too
+                if not is_error_response(result) or not pending:
+                    if future is hedge_future:
+                        with self._lock:
+                            self.hedges_won += 1
+                    return result
+
+    def summary(self):
+        return "hedging: {} of {} requests hedged ({} won, {} skipped by the spend cap)".format(
+            self.hedges_fired, self.requests, self.hedges_won, self.hedges_skipped
+        )
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Load test of the gpt_request.py generation pipeline against the local mock
+server (mock_llm_server.py), without spending tokens.
+
+The server runs in-process with the requested latency distribution and
+error/429 rates. Questions come from --eval_path/--db_root_path, or from a
+small synthetic SQLite dataset generated on the fly so the test runs on a
+plain Linux box. The report has requests/sec, concurrency efficiency (achieved
+throughput divided by concurrency / mean latency) and retry behavior. The
+process exits with status 1 when --min_rps or --min_efficiency is not met,
+which lets CI catch regressions in the client's concurrency model.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import gpt_request
+from mock_llm_server import MockState, load_canned_sql, make_server
+from request_metrics import RequestMetrics
+
+
+def build_synthetic_dataset(root, num_questions, num_dbs=3):
+    """
+    Write num_dbs small SQLite databases under root and return (eval_data, db_root_path).
+    """
+    db_root_path = os.path.join(root, "databases") + "/"
+    db_ids = [f"load_test_{n}" for n in range(num_dbs)]
+    for db_id in db_ids:
+        os.makedirs(db_root_path + db_id, exist_ok=True)
+        conn = sqlite3.connect(db_root_path + f"{db_id}/{db_id}.sqlite")
+        conn.executescript(
+            "CREATE TABLE IF NOT EXISTS customers (id INTEGER PRIMARY KEY, name TEXT, city TEXT);"
+            "CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY, "
+            "customer_id INTEGER REFERENCES customers(id), amount REAL);"
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO customers VALUES (?, ?, ?)",
+            [(i, f"customer {i}", f"city {i % 7}") for i in range(20)],
+        )
+        conn.commit()
+        conn.close()
+    eval_data = [
+        {
+            "question": f"How many customers of city {i % 7} placed orders above {i}?",
+            "db_id": db_ids[i % num_dbs],
+            "evidence": "",
+            "SQL": f"SELECT COUNT(*) FROM orders WHERE amount > {i}",
+        }
+        for i in range(num_questions)
+    ]
+    return eval_data, db_root_path
+
+
+def run_load_test(
+    eval_data,
+    db_root_path,
+    url,
+    engine,
+    mode,
+    concurrency,
+    num_requests,
+):
+    """
+    Run the selected request engine over the questions and return
+    (elapsed seconds, RequestMetrics).
+    """
+    eval_data = eval_data[:num_requests]
+    question_list, db_path_list, knowledge_list = gpt_request.decouple_question_schema(
+        datasets=eval_data, db_root_path=db_root_path
+    )
+    gpt_request.api_base = url
+    metrics = RequestMetrics()
+    start = time.monotonic()
+    if mode == "async":
+        gpt_request.collect_response_from_gpt_async(
+            db_path_list,
+            question_list,
+            "mock-key",
+            engine,
+            "SQLite",
+            knowledge_list,
+            max_in_flight=concurrency,
+            metrics=metrics,
+        )
+    else:
+        gpt_request.collect_response_from_gpt(
+            db_path_list,
+            question_list,
+            "mock-key",
+            engine,
+            "SQLite",
+            concurrency,
+            knowledge_list,
+            metrics=metrics,
+        )
+    return time.monotonic() - start, metrics
+
+
+def build_report(elapsed, metrics, server_stats, concurrency):
+    latencies = [r["latency"] for r in metrics.records if r["outcome"] == "ok"]
+    mean_latency = sum(latencies) / len(latencies) if latencies else None
+    requests = len(metrics.records)
+    requests_per_second = requests / elapsed if elapsed else 0.0
+    ideal_requests_per_second = concurrency / mean_latency if mean_latency else None
+    attempts = sum(r["attempts"] for r in metrics.records)
+    return {
+        "requests": requests,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": requests_per_second,
+        "mean_latency": mean_latency,
+        "ideal_requests_per_second": ideal_requests_per_second,
+        "concurrency_efficiency": (
+            requests_per_second / ideal_requests_per_second
+            if ideal_requests_per_second
+            else None
+        ),
+        "attempts": attempts,
+        "retries": attempts - requests,
+        "retry_rate": (
+            sum(1 for r in metrics.records if r["attempts"] > 1) / requests
+            if requests
+            else 0.0
+        ),
+        "failed_requests": sum(1 for r in metrics.records if r["outcome"] == "error"),
+        "server": server_stats,
+        "per_engine": metrics.summary(),
+    }
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--eval_path", type=str, default=None)
+    args_parser.add_argument("--db_root_path", type=str, default=None)
+    args_parser.add_argument("--engine", type=str, default="gpt-4")
+    args_parser.add_argument("--mode", type=str, default="async", choices=["async", "thread"])
+    args_parser.add_argument("--concurrency", type=int, default=32)
+    args_parser.add_argument("--num_requests", type=int, default=200)
+    args_parser.add_argument("--latency", type=str, default="lognormal:0.3,0.5")
+    args_parser.add_argument("--error_rate", type=float, default=0.0)
+    args_parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    args_parser.add_argument("--retry_after", type=float, default=0.5)
+    args_parser.add_argument("--seed", type=int, default=0)
+    args_parser.add_argument("--report_path", type=str, default=None)
+    args_parser.add_argument("--min_rps", type=float, default=0)
+    args_parser.add_argument("--min_efficiency", type=float, default=0)
+    args = args_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.eval_path:
+            eval_data = json.load(open(args.eval_path, "r"))
+            db_root_path = args.db_root_path
+            canned_sql = load_canned_sql(args.eval_path)
+        else:
+            eval_data, db_root_path = build_synthetic_dataset(tmp_dir, args.num_requests)
+            canned_sql = {data["question"]: data["SQL"] for data in eval_data}
+
+        state = MockState(
+            latency=args.latency,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+            retry_after=args.retry_after,
+            canned_sql=canned_sql,
+            seed=args.seed,
+        )
+        server = make_server("127.0.0.1", 0, state)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        elapsed, metrics = run_load_test(
+            eval_data,
+            db_root_path,
+            url,
+            args.engine,
+            args.mode,
+            args.concurrency,
+            args.num_requests,
+        )
+        server.shutdown()
+
+    report = build_report(elapsed, metrics, state.stats(), args.concurrency)
+    print(metrics.format_summary())
+    print(
+        "{} requests in {:.2f}s: {:.2f} req/s, concurrency efficiency {}, "
+        "{} retries ({:.1%} of requests retried), server saw {}".format(
+            report["requests"],
+            report["elapsed_seconds"],
+            report["requests_per_second"],
+            "-"
+            if report["concurrency_efficiency"] is None
+            else "{:.1%}".format(report["concurrency_efficiency"]),
+            report["retries"],
+            report["retry_rate"],
+            report["server"],
+        )
+    )
+    if args.report_path:
+        with open(args.report_path, "w") as f:
+            json.dump(report, f, indent=4)
+
+    failed = []
+    if report["requests_per_second"] < args.min_rps:
+        failed.append(f"req/s below {args.min_rps}")
+    if args.min_efficiency and (report["concurrency_efficiency"] or 0) < args.min_efficiency:
+        failed.append(f"concurrency efficiency below {args.min_efficiency}")
+    if failed:
+        print("load test failed: " + ", ".join(failed))
+        sys.exit(1)
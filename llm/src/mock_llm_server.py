@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Azure OpenAI endpoints used by gpt_request.py, so the
+request and batch modes can be exercised without spending tokens.
+
+Served under any deployment prefix (e.g. /openai/deployments/<engine>/...):
+    POST .../chat/completions, POST .../completions
+    POST .../files, GET .../files/<id>, GET .../files/<id>/content
+    POST .../batches, GET .../batches/<id>
+
+Completions can be slowed down by a latency distribution, fail with HTTP 500
+or be rate limited with HTTP 429 + Retry-After at configurable rates, and
+answer with the gold SQL of the question found in the prompt (--canned_path,
+a mini_dev-style JSON file with "question" and "SQL" fields).
+
+Usage:
+    python3 mock_llm_server.py --port 8765 --latency lognormal:0.5,0.6 --rate_limit_rate 0.05
+    python3 gpt_request.py ... --api_base http://127.0.0.1:8765
+"""
+import argparse
+import copy
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def chat_completion(model, content, prompt_tokens=100):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content},
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content.split()),
+            "total_tokens": prompt_tokens + len(content.split()),
+        },
+    }
+
+
+def text_completion(model, text, prompt_tokens=100):
+    return {
+        "id": f"cmpl-{uuid.uuid4().hex}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop", "text": text}],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(text.split()),
+            "total_tokens": prompt_tokens + len(text.split()),
+        },
+    }
+
+
+def parse_latency(spec):
+    """
+    Parse a latency distribution into a sampler returning seconds:
+    constant:S, uniform:LOW,HIGH, exponential:MEAN or lognormal:MEDIAN,SIGMA.
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if kind == "constant":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"unknown latency distribution {spec}")
+
+
+def load_canned_sql(path):
+    """
+    {question: gold SQL} from a mini_dev-style JSON file.
+    """
+    with open(path, "r") as f:
+        return {data["question"]: data["SQL"] for data in json.load(f) if "SQL" in data}
+
+
+def prompt_text(body):
+    if "messages" in body:
+        return body["messages"][-1]["content"]
+    return body.get("prompt") or ""
+
+
+def parse_multipart(content_type, body):
+    """
+    Return {field name: (filename, bytes)} of a multipart/form-data body.
+    """
+    message = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        fields[name] = (part.get_filename(), part.get_payload(decode=True))
+    return fields
+
+
+class MockState:
+    """
+    Uploaded files and batches, shared by all handler threads.
+    """
+
+    def __init__(
+        self,
+        sql="SELECT 1",
+        batch_delay=1.0,
+        latency="constant:0",
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        retry_after=1.0,
+        canned_sql=None,
+        seed=None,
+    ):
+        self.sql = sql
+        self.batch_delay = batch_delay
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.canned_sql = canned_sql or {}
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.batches = {}
+        self.counters = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def answer(self, body):
+        prompt = prompt_text(body)
+        for question, sql in self.canned_sql.items():
+            if question in prompt:
+                return sql
+        return self.sql
+
+    def completion(self, endpoint, body):
+        if endpoint.endswith("/chat/completions"):
+            return chat_completion(body.get("model"), self.answer(body))
+        return text_completion(body.get("model"), self.answer(body))
+
+    def draw_fault(self):
+        """
+        Decide how a completion request is served: "rate_limited", "error" or
+        None, together with its latency.
+        """
+        with self.lock:
+            self.counters["requests"] += 1
+            roll = self.rng.random()
+            latency = self.sample_latency(self.rng)
+        if roll < self.rate_limit_rate:
+            return "rate_limited", 0.0
+        if roll < self.rate_limit_rate + self.error_rate:
+            return "error", latency
+        return None, latency
+
+    def count(self, counter, delta=1):
+        with self.lock:
+            self.counters[counter] += delta
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, max_in_flight=self.max_in_flight)
+
+    def add_file(self, filename, content, purpose):
+        file_object = {
+            "id": f"file-{uuid.uuid4().hex}",
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self.lock:
+            self.files[file_object["id"]] = (file_object, content)
+        return file_object
+
+    def create_batch(self, body):
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "completion_window": body.get("completion_window", "24h"),
+            "input_file_id": body["input_file_id"],
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self.run_batch, args=(batch,), daemon=True).start()
+        return batch
+
+    def run_batch(self, batch):
+        _, content = self.files[batch["input_file_id"]]
+        requests = [json.loads(line) for line in content.decode().splitlines() if line]
+        with self.lock:
+            batch["status"] = "in_progress"
+            batch["request_counts"]["total"] = len(requests)
+        time.sleep(self.batch_delay)
+
+        output = []
+        for request in requests:
+            output.append(
+                {
+                    "id": f"response-{uuid.uuid4().hex}",
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": self.completion(request["url"], request["body"]),
+                    },
+                    "error": None,
+                }
+            )
+        output_file = self.add_file(
+            "output.jsonl",
+            "".join(json.dumps(line) + "\n" for line in output).encode(),
+            "batch_output",
+        )
+        with self.lock:
+            batch["request_counts"]["completed"] = len(output)
+            batch["output_file_id"] = output_file["id"]
+            batch["status"] = "completed"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("content-length", 0)))
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/completions"):
+            self.handle_completion(path, json.loads(self.read_body()))
+        elif path.endswith("/files"):
+            fields = parse_multipart(self.headers["content-type"], self.read_body())
+            filename, content = fields["file"]
+            purpose = fields.get("purpose", (None, b"batch"))[1].decode()
+            self.send_json(200, self.state.add_file(filename, content, purpose))
+        elif path.endswith("/batches"):
+            self.send_json(200, self.state.create_batch(json.loads(self.read_body())))
+        else:
+            self.send_json(404, {"error": {"message": f"unknown path {path}"}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        match = re.search(r"/files/([^/]+)(/content)?$", path)
+        if match and match.group(1) in self.state.files:
+            file_object, content = self.state.files[match.group(1)]
+            if not match.group(2):
+                self.send_json(200, file_object)
+                return
+            self.send_response(200)
+            self.send_header("content-type", "application/octet-stream")
+            self.send_header("content-length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        match = re.search(r"/batches/([^/]+)$", path)
+        if match and match.group(1) in self.state.batches:
+            with self.state.lock:
+                batch = copy.deepcopy(self.state.batches[match.group(1)])
+            self.send_json(200, batch)
+            return
+        self.send_json(404, {"error": {"message": f"unknown path {path}"}})
+
+    def handle_completion(self, path, body):
+        fault, latency = self.state.draw_fault()
+        if fault == "rate_limited":
+            self.state.count("rate_limited")
+            self.send_json(
+                429,
+                {"error": {"code": "429", "message": "Rate limit exceeded (mock)"}},
+                {"retry-after": str(self.state.retry_after)},
+            )
+            return
+        self.state.enter()
+        try:
+            time.sleep(latency)
+        finally:
+            self.state.leave()
+        if fault == "error":
+            self.state.count("errors")
+            self.send_json(500, {"error": {"code": "500", "message": "Internal error (mock)"}})
+            return
+        self.state.count("ok")
+        self.send_json(200, self.state.completion(path, body))
+
+
+def make_server(host, port, state):
+    handler = type("Handler", (MockHandler,), {"state": state})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--host", type=str, default="127.0.0.1")
+    args_parser.add_argument("--port", type=int, default=8765)
+    args_parser.add_argument("--sql", type=str, default="SELECT 1")
+    args_parser.add_argument("--batch_delay", type=float, default=1.0)
+    args_parser.add_argument("--latency", type=str, default="constant:0")
+    args_parser.add_argument("--error_rate", type=float, default=0.0)
+    args_parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    args_parser.add_argument("--retry_after", type=float, default=1.0)
+    args_parser.add_argument("--canned_path", type=str, default=None)
+    args_parser.add_argument("--seed", type=int, default=None)
+    args = args_parser.parse_args()
+
+    state = MockState(
+        args.sql,
+        args.batch_delay,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        canned_sql=load_canned_sql(args.canned_path) if args.canned_path else None,
+        seed=args.seed,
+    )
+    server = make_server(args.host, args.port, state)
+    print(f"mock LLM server listening on http://{args.host}:{args.port}")
+    server.serve_forever()
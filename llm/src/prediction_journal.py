@@ -0,0 +1,77 @@
+"""
+Append-only JSONL journal of completed predictions.
+
+Each finished question is written as {"idx": i, "sql": sql} as soon as its
+response arrives, so an interrupted run can be resumed without re-querying
+the questions that are already done. Failed requests ("error:..." responses)
+are journaled too, so the output file stays complete, but they do not count as
+done: a resumed run queries them again.
+"""
+import json
+import os
+import threading
+
+
+ERROR_PREFIX = "error:"
+
+
+def is_error_prediction(sql):
+    """
+    Whether a journaled prediction is the "error:..." response of a failed request.
+    """
+    return not isinstance(sql, str) or sql.startswith(ERROR_PREFIX)
+
+
+def load_journal(path):
+    """
+    Return {idx: sql} from a journal; a torn last line from a crash and failed
+    requests (see is_error_prediction) are ignored.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if is_error_prediction(record["sql"]):
+                continue
+            done[record["idx"]] = record["sql"]
+    return done
+
+
+class PredictionJournal:
+    def __init__(self, path, resume=False):
+        self.path = path
+        directory_path = os.path.dirname(path)
+        if directory_path:
+            os.makedirs(directory_path, exist_ok=True)
+        self.done = load_journal(path) if resume else {}
+        self._lock = threading.Lock()
+        self._file = open(path, "a" if resume else "w")
+        if resume and self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+            if torn:
+                # terminate a torn last line so the next record starts cleanly
+                self._file.write("\n")
+
+    def append(self, sql, i):
+        line = json.dumps({"idx": i, "sql": sql}) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.done[i] = sql
+
+    def results(self):
+        """
+        All journaled predictions as [(sql, idx), ...], the format of generate_sql_file.
+        """
+        return [(sql, i) for i, sql in self.done.items()]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
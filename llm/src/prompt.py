@@ -1,4 +1,8 @@
-from table_schema import generate_schema_prompt
+from functools import lru_cache
+
+from schema_pruning import prune_schema_dict, select_tables
+from table_schema import get_schema_dict
+from value_index import lookup_values
 
 
 def generate_comment_prompt(question, sql_dialect, knowledge=None):
@@ -14,10 +18,19 @@ def generate_comment_prompt(question, sql_dialect, knowledge=None):
     return combined_prompt
 
 
+def generate_value_prompt(matches):
+    lines = ["-- Database values that may be mentioned in the question:"]
+    for table, column, value in matches:
+        lines.append(f"-- {table}.{column}: '{value}'")
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=None)
 def generate_cot_prompt(sql_dialect):
     return f"\nGenerate the {sql_dialect} for the above question after thinking step by step: "
 
 
+@lru_cache(maxsize=None)
 def generate_instruction_prompt(sql_dialect):
     return f"""
         \nIn your response, you do not need to mention your intermediate steps. 
@@ -28,13 +41,52 @@ def generate_instruction_prompt(sql_dialect):
         """
 
 
-def generate_combined_prompts_one(db_path, question, sql_dialect, knowledge=None):
-    schema_prompt = generate_schema_prompt(sql_dialect, db_path)
+def generate_combined_prompts_one(
+    db_path,
+    question,
+    sql_dialect,
+    knowledge=None,
+    schema_cache_dir=None,
+    column_stats=False,
+    value_index_root=None,
+    schema_top_k=None,
+    pruning_report=None,
+    prompt_layout="default",
+):
+    """
+    prompt_layout="prefix_stable" moves the static instructions right after the
+    schema, so every question on a database shares a byte-identical prefix that
+    provider-side and vLLM prefix caches can reuse. schema_top_k prunes the
+    schema per question, which breaks that shared prefix.
+    """
+    schemas = get_schema_dict(
+        sql_dialect, db_path, cache_dir=schema_cache_dir, column_stats=column_stats
+    )
+    schema_prompt = "\n\n".join(schemas.values())
+    if schema_top_k:
+        kept_tables = select_tables(db_path, question, knowledge, schema_top_k)
+        pruned_prompt = "\n\n".join(prune_schema_dict(schemas, kept_tables).values())
+        if pruning_report is not None:
+            db_id = db_path.split("/")[-1].split(".sqlite")[0]
+            pruning_report.record(
+                db_id, question, kept_tables, len(schemas), schema_prompt, pruned_prompt
+            )
+        schema_prompt = pruned_prompt
     comment_prompt = generate_comment_prompt(question, sql_dialect, knowledge)
     cot_prompt = generate_cot_prompt(sql_dialect)
     instruction_prompt = generate_instruction_prompt(sql_dialect)
 
-    combined_prompts = "\n\n".join(
-        [schema_prompt, comment_prompt, cot_prompt, instruction_prompt]
-    )
+    if prompt_layout == "prefix_stable":
+        prompts = [schema_prompt, instruction_prompt, comment_prompt, cot_prompt]
+        question_position = 2
+    else:
+        prompts = [schema_prompt, comment_prompt, cot_prompt, instruction_prompt]
+        question_position = 1
+    if value_index_root:
+        db_id = db_path.split("/")[-1].split(".sqlite")[0]
+        matches = lookup_values(value_index_root, db_id, question)
+        if matches:
+            prompts.insert(question_position, generate_value_prompt(matches))
+
+    combined_prompts = "\n\n".join(prompts)
     return combined_prompts
@@ -0,0 +1,135 @@
+"""
+Per-request telemetry for gpt_request.py: latency, token usage, attempts and
+outcome of every API request, dumped to JSONL or CSV and summarized per engine
+(latency percentiles, throughput and retry rate) to tune num_threads and rate
+limits against the quota.
+"""
+import csv
+import json
+import threading
+
+from response_cache import is_error_response
+
+
+FIELDS = [
+    "engine",
+    "start",
+    "end",
+    "latency",
+    "wall_time",
+    "attempts",
+    "outcome",
+    "error_class",
+    "prompt_tokens",
+    "completion_tokens",
+]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class RequestMetrics:
+    """
+    Thread-safe collector of one record per request.
+
+    latency is the duration of the last attempt; wall_time also includes
+    failed attempts and the sleeps between retries.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, engine, start, end, latency, attempts, response, error_class=None):
+        # plain-text results (instruct engine, errors) carry no usage
+        usage = getattr(response, "usage", None)
+        record = {
+            "engine": engine,
+            "start": start,
+            "end": end,
+            "latency": latency,
+            "wall_time": end - start,
+            "attempts": attempts,
+            "outcome": "error" if is_error_response(response) else "ok",
+            "error_class": error_class,
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+        }
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self):
+        """
+        {engine: statistics} over all recorded requests.
+        """
+        by_engine = {}
+        with self._lock:
+            for record in self.records:
+                by_engine.setdefault(record["engine"], []).append(record)
+
+        summary = {}
+        for engine, records in by_engine.items():
+            latencies = [r["latency"] for r in records if r["outcome"] == "ok"]
+            elapsed = max(r["end"] for r in records) - min(r["start"] for r in records)
+            completion_tokens = sum(r["completion_tokens"] or 0 for r in records)
+            error_classes = {}
+            for r in records:
+                if r["error_class"]:
+                    error_classes[r["error_class"]] = error_classes.get(r["error_class"], 0) + 1
+            summary[engine] = {
+                "requests": len(records),
+                "errors": sum(1 for r in records if r["outcome"] == "error"),
+                "p50_latency": percentile(latencies, 50),
+                "p95_latency": percentile(latencies, 95),
+                "p99_latency": percentile(latencies, 99),
+                "requests_per_second": len(records) / elapsed if elapsed else None,
+                "completion_tokens_per_second": (
+                    completion_tokens / elapsed if elapsed else None
+                ),
+                "retry_rate": sum(1 for r in records if r["attempts"] > 1) / len(records),
+                "error_classes": error_classes,
+            }
+        return summary
+
+    def format_summary(self):
+        def fmt(value):
+            return "-" if value is None else "{:.2f}".format(value)
+
+        lines = []
+        for engine, stats in self.summary().items():
+            lines.append(
+                "{}: {} requests ({} failed), latency p50/p95/p99 {}/{}/{} s, "
+                "{} req/s, {} completion tokens/s, retry rate {:.1%}".format(
+                    engine,
+                    stats["requests"],
+                    stats["errors"],
+                    fmt(stats["p50_latency"]),
+                    fmt(stats["p95_latency"]),
+                    fmt(stats["p99_latency"]),
+                    fmt(stats["requests_per_second"]),
+                    fmt(stats["completion_tokens_per_second"]),
+                    stats["retry_rate"],
+                )
+            )
+            if stats["error_classes"]:
+                lines.append(f"{engine}: errors by class {stats['error_classes']}")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """
+        Write every record to path, as CSV if it ends with .csv and JSONL otherwise.
+        """
+        with self._lock:
+            records = list(self.records)
+        with open(path, "w", newline="") as f:
+            if path.endswith(".csv"):
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
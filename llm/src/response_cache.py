@@ -0,0 +1,75 @@
+"""
+On-disk cache of LLM responses keyed by (engine, prompt hash, temperature,
+max_tokens, stop), so that re-running gpt_request.py does not re-query the API.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def is_error_response(response):
+    # connect_gpt returns "error:<message>" once all retries are exhausted
+    return isinstance(response, str) and response.startswith("error:")
+
+
+def response_content(response):
+    return response if isinstance(response, str) else response.choices[0].message.content
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache shared by all request threads.
+
+    ttl: seconds after which an entry is ignored (None keeps entries forever).
+    bypass: skip lookups but still store fresh responses, to refresh the cache.
+    """
+
+    def __init__(self, path, ttl=None, bypass=False):
+        self.ttl = ttl
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, engine TEXT, response TEXT, created_at REAL)"
+        )
+
+    @staticmethod
+    def make_key(engine, prompt, temperature, max_tokens, stop):
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        key = json.dumps([engine, prompt_hash, temperature, max_tokens, stop])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, engine, prompt, temperature, max_tokens, stop):
+        if self.bypass:
+            return None
+        key = self.make_key(engine, prompt, temperature, max_tokens, stop)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl and time.time() - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0]
+
+    def put(self, engine, prompt, temperature, max_tokens, stop, response):
+        if is_error_response(response):
+            return
+        key = self.make_key(engine, prompt, temperature, max_tokens, stop)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, engine, response, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, engine, response_content(response), time.time()),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
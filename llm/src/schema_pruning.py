@@ -0,0 +1,194 @@
+"""
+Relevance-based schema pruning for mini-dev prompts.
+
+A lexical index over the table and column names of each database is built once.
+For every question, tables are ranked against the question and evidence text,
+and only the top-k tables, the tables they reference through foreign keys and
+the linking tables that join two of them are kept in the prompt.
+"""
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+
+
+_schema_indexes = {}
+
+
+def split_identifier(name):
+    """
+    Split snake_case / camelCase / spaced identifiers into lowercase words.
+    """
+    words = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", name)
+    return [normalize_token(word) for word in words]
+
+
+def normalize_token(token):
+    token = token.lower()
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        token = token[:-1]
+    return token
+
+
+def tokenize(text):
+    tokens = set()
+    for word in re.findall(r"\w+", text or ""):
+        tokens.update(split_identifier(word))
+    return tokens
+
+
+def build_schema_index(db_path):
+    """
+    Collect name tokens, column tokens and foreign-key references of every table,
+    plus the idf of each token across tables.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    tables = [
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+    table_tokens = {}
+    foreign_keys = {}
+    for table in tables:
+        quoted_table = '"{}"'.format(table.replace('"', '""'))
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quoted_table})")]
+        column_tokens = set()
+        for column in columns:
+            column_tokens.update(split_identifier(column))
+        table_tokens[table.lower()] = (set(split_identifier(table)), column_tokens)
+        foreign_keys[table.lower()] = {
+            row[2].lower() for row in conn.execute(f"PRAGMA foreign_key_list({quoted_table})")
+        }
+    conn.close()
+
+    document_frequency = {}
+    for name_tokens, column_tokens in table_tokens.values():
+        for token in name_tokens | column_tokens:
+            document_frequency[token] = document_frequency.get(token, 0) + 1
+    idf = {
+        token: math.log(1 + len(tables) / df) for token, df in document_frequency.items()
+    }
+    return {
+        "tables": [table.lower() for table in tables],
+        "table_tokens": table_tokens,
+        "foreign_keys": foreign_keys,
+        "idf": idf,
+    }
+
+
+def get_schema_index(db_path):
+    stat = os.stat(db_path)
+    key = (os.path.abspath(db_path), stat.st_mtime_ns, stat.st_size)
+    index = _schema_indexes.get(key)
+    if index is None:
+        index = build_schema_index(db_path)
+        _schema_indexes[key] = index
+    return index
+
+
+def select_tables(db_path, question, evidence=None, top_k=3):
+    """
+    Return the lowercase names of the top_k tables most relevant to the question
+    and evidence, closed under foreign-key references, plus the tables whose
+    foreign keys reference at least two of those (linking tables). All tables
+    are kept when nothing in the text matches the schema.
+    """
+    index = get_schema_index(db_path)
+    query_tokens = tokenize(question) | tokenize(evidence)
+    scores = {}
+    for table in index["tables"]:
+        name_tokens, column_tokens = index["table_tokens"][table]
+        score = 0.0
+        for token in query_tokens:
+            if token in name_tokens:
+                score += 3 * index["idf"][token]
+            elif token in column_tokens:
+                score += index["idf"][token]
+        if score > 0:
+            scores[table] = score
+    if not scores:
+        return set(index["tables"])
+
+    ranked = sorted(scores, key=lambda table: -scores[table])[:top_k]
+    selected = close_under_foreign_keys(index, ranked)
+    # foreign keys only point from child to parent, so a many-to-many join
+    # table between two kept tables is not reached above; keep it as well
+    linking = [
+        table
+        for table in index["tables"]
+        if table not in selected
+        and len(index["foreign_keys"].get(table, set()) & selected) >= 2
+    ]
+    return close_under_foreign_keys(index, linking, selected)
+
+
+def close_under_foreign_keys(index, tables, selected=None):
+    """
+    selected plus tables and every table they transitively reference.
+    """
+    selected = set(selected or ())
+    pending = list(tables)
+    while pending:
+        table = pending.pop()
+        if table in selected:
+            continue
+        selected.add(table)
+        pending.extend(index["foreign_keys"].get(table, ()))
+    return selected
+
+
+def prune_schema_dict(schemas, tables):
+    return {
+        table: ddl for table, ddl in schemas.items() if table.lower() in tables
+    }
+
+
+def count_tokens(text):
+    # rough estimate (~4 characters per token); only used for savings reports
+    return max(1, len(text) // 4)
+
+
+class PruningReport:
+    """
+    Thread-safe collector of per-question prompt token savings.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, db_id, question, kept_tables, total_tables, full_schema, pruned_schema):
+        full_tokens = count_tokens(full_schema)
+        pruned_tokens = count_tokens(pruned_schema)
+        with self._lock:
+            self.records.append(
+                {
+                    "db_id": db_id,
+                    "question": question,
+                    "kept_tables": sorted(kept_tables),
+                    "total_tables": total_tables,
+                    "full_schema_tokens": full_tokens,
+                    "pruned_schema_tokens": pruned_tokens,
+                    "saved_tokens": full_tokens - pruned_tokens,
+                }
+            )
+
+    def summary(self):
+        full = sum(r["full_schema_tokens"] for r in self.records)
+        saved = sum(r["saved_tokens"] for r in self.records)
+        return {
+            "questions": len(self.records),
+            "full_schema_tokens": full,
+            "saved_tokens": saved,
+            "saved_ratio": saved / full if full else 0.0,
+        }
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {"summary": self.summary(), "questions": self.records}, f, indent=4
+            )
@@ -0,0 +1,160 @@
+"""
+Streaming EX / F1 evaluation for gpt_request.py.
+
+Each prediction is submitted to a multiprocessing pool of the evaluation
+scripts' execute_model as soon as it is generated. Scoring overlaps the API
+phase, and a running accuracy is printed along the way. finish() waits for
+the pool and reports the same difficulty breakdown as evaluation_ex.py and
+evaluation_f1.py.
+
+The evaluation scripts are only imported (and their folder only added to
+sys.path) when an evaluator is created, so importing this module is free.
+"""
+import importlib
+import multiprocessing as mp
+import os
+import sys
+import threading
+
+EVALUATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../../evaluation")
+
+# metric: (evaluation module, compute_by_diff name, label used by the evaluation scripts)
+METRICS = {
+    "EX": ("evaluation_ex", "compute_acc_by_diff", "EX"),
+    "F1": ("evaluation_f1", "compute_f1_by_diff", "Soft-F1"),
+}
+
+
+def add_evaluation_path():
+    """
+    Make the evaluation scripts importable; also the initializer of the pool
+    processes, which unpickle their execute_model by module name.
+    """
+    if EVALUATION_DIR not in sys.path:
+        sys.path.insert(0, EVALUATION_DIR)
+
+
+def import_evaluation(module_name):
+    add_evaluation_path()
+    return importlib.import_module(module_name)
+
+
+def split_prediction(sql_str):
+    """
+    The predicted SQL of a generated "sql\\t----- bird -----\\tdb_id" string,
+    parsed the way package_sqls(mode="pred") does.
+    """
+    if not isinstance(sql_str, str):
+        return " "
+    try:
+        sql, _ = sql_str.split("\t----- bird -----\t")
+    except ValueError:
+        sql = sql_str.strip()
+    return sql
+
+
+class StreamingEvaluator:
+    """
+    on_result-compatible sink: evaluator(sql, i) scores question i against
+    line i of the ground-truth file.
+    """
+
+    def __init__(
+        self,
+        ground_truth_path,
+        db_root_path,
+        diff_json_path,
+        num_cpus=1,
+        meta_time_out=30.0,
+        sql_dialect="SQLite",
+        metrics=("EX", "F1"),
+        report_every=10,
+    ):
+        self.utils = import_evaluation("evaluation_utils")
+        self.gt_queries, self.db_paths = self.utils.package_sqls(
+            ground_truth_path, db_root_path, mode="gt"
+        )
+        self.diff_json_path = diff_json_path
+        self.meta_time_out = meta_time_out
+        self.sql_dialect = sql_dialect
+        self.metrics = list(metrics)
+        self.modules = {
+            metric: import_evaluation(METRICS[metric][0]) for metric in self.metrics
+        }
+        self.report_every = report_every
+        self.results = {metric: [] for metric in self.metrics}
+        self._lock = threading.Lock()
+        # created before any request thread exists, so forking stays safe
+        self.pool = mp.Pool(processes=num_cpus, initializer=add_evaluation_path)
+
+    def __call__(self, sql, i):
+        predicted_sql = split_prediction(sql)
+        for metric in self.metrics:
+            execute_model = self.modules[metric].execute_model
+            self.pool.apply_async(
+                execute_model,
+                args=(
+                    predicted_sql,
+                    self.gt_queries[i],
+                    self.db_paths[i],
+                    i,
+                    self.meta_time_out,
+                    self.sql_dialect,
+                ),
+                callback=lambda result, metric=metric: self._collect(metric, result),
+                error_callback=lambda error, metric=metric, i=i: print(
+                    f"Warning: {metric} evaluation of question {i} failed: {error!r}"
+                ),
+            )
+
+    def _collect(self, metric, result):
+        with self._lock:
+            self.results[metric].append(result)
+            if metric == self.metrics[0] and len(self.results[metric]) % self.report_every == 0:
+                print(self.running_summary())
+
+    def running_summary(self):
+        parts = []
+        for metric in self.metrics:
+            results = self.results[metric]
+            score = sum(r["res"] for r in results) / len(results) * 100 if results else 0.0
+            parts.append(f"{metric} {score:.2f} over {len(results)}")
+        return "[live] " + ", ".join(parts) + f" of {len(self.gt_queries)} questions"
+
+    def complete_results(self, metric):
+        """
+        The results of metric sorted by question, one per ground-truth line.
+        compute_by_diff pairs the i-th result with the i-th difficulty, so a
+        question without a result (never generated, or its evaluation failed)
+        is warned about and scored 0 instead of shifting all later questions.
+        """
+        by_index = {result["sql_idx"]: result for result in self.results[metric]}
+        missing = [i for i in range(len(self.gt_queries)) if i not in by_index]
+        if missing:
+            print(
+                f"Warning: {len(missing)} of {len(self.gt_queries)} questions have no "
+                f"{metric} result and are scored 0 (first: {missing[:10]})"
+            )
+            for i in missing:
+                by_index[i] = {"sql_idx": i, "res": 0}
+        return self.utils.sort_results(list(by_index.values()))
+
+    def finish(self, output_log_path=None):
+        """
+        Wait for all pending evaluations, print the difficulty breakdown of each
+        metric and return {metric: (score_lists, count_lists)}.
+        """
+        self.pool.close()
+        self.pool.join()
+        scores = {}
+        for metric in self.metrics:
+            _, compute_name, label = METRICS[metric]
+            compute_by_diff = getattr(self.modules[metric], compute_name)
+            exec_result = self.complete_results(metric)
+            print(f"start calculate {label}")
+            *score_lists, count_lists = compute_by_diff(exec_result, self.diff_json_path)
+            self.utils.print_data(
+                score_lists, count_lists, metric=label, result_log_file=output_log_path
+            )
+            scores[metric] = (score_lists, count_lists)
+        return scores
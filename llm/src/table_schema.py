@@ -1,7 +1,12 @@
+import hashlib
+import json
+import os
 import sqlite3
 import pymysql
 import psycopg2
 
+from column_stats import add_column_stats, column_stats_path, load_column_stats
+
 db_table_map = {
     "debit_card_specializing": [
         "customers",
@@ -111,14 +116,13 @@ def nice_look_table(column_names: list, values: list):
     return final_output
 
 
-def generate_schema_prompt_sqlite(db_path, num_rows=None):
+def generate_schema_dict_sqlite(db_path, num_rows=None):
     # extract create ddls
     """
-    :param root_place:
-    :param db_name:
-    :return:
+    :param db_path:
+    :param num_rows:
+    :return: {table_name: create ddl (plus example rows)}
     """
-    full_schema_prompt_list = []
     conn = sqlite3.connect(db_path)
     # Create a cursor object
     cursor = conn.cursor()
@@ -148,13 +152,14 @@ def generate_schema_prompt_sqlite(db_path, num_rows=None):
                 num_rows, cur_table, num_rows, rows_prompt
             )
             schemas[table[0]] = "{} \n {}".format(create_prompt, verbose_prompt)
+    conn.close()
 
-    for k, v in schemas.items():
-        full_schema_prompt_list.append(v)
+    return schemas
 
-    schema_prompt = "\n\n".join(full_schema_prompt_list)
 
-    return schema_prompt
+def generate_schema_prompt_sqlite(db_path, num_rows=None):
+    schemas = generate_schema_dict_sqlite(db_path, num_rows)
+    return "\n\n".join(schemas.values())
 
 
 def connect_mysql():
@@ -210,7 +215,7 @@ def format_postgresql_create_table(table_name, columns_info):
     return "\n".join(lines)
 
 
-def generate_schema_prompt_mysql(db_path):
+def generate_schema_dict_mysql(db_path):
     db = connect_mysql()
     cursor = db.cursor()
     db_name = db_path.split("/")[-1].split(".sqlite")[0]
@@ -221,9 +226,17 @@ def generate_schema_prompt_mysql(db_path):
         raw_schema = cursor.fetchall()
         pretty_schema = format_mysql_create_table(table, raw_schema)
         schemas[table] = pretty_schema
-    schema_prompt = "\n\n".join(schemas.values())
     db.close()
-    return schema_prompt
+    return schemas
+
+
+def generate_schema_prompt_mysql(db_path):
+    return "\n\n".join(generate_schema_dict_mysql(db_path).values())
+
+
+# schema of the BIRD tables in the PostgreSQL database; other schemas may hold
+# tables of the same name
+POSTGRESQL_SCHEMA = "public"
 
 
 def connect_postgresql():
@@ -235,7 +248,7 @@ def connect_postgresql():
     return db
 
 
-def generate_schema_prompt_postgresql(db_path):
+def generate_schema_dict_postgresql(db_path):
     db = connect_postgresql()
     cursor = db.cursor()
     db_name = db_path.split("/")[-1].split(".sqlite")[0]
@@ -246,15 +259,113 @@ def generate_schema_prompt_postgresql(db_path):
             f"""
                 SELECT column_name, data_type, is_nullable
                 FROM information_schema.columns
-                WHERE table_name = '{table}';
+                WHERE table_schema = '{POSTGRESQL_SCHEMA}' AND table_name = '{table}'
+                ORDER BY ordinal_position;
             """
         )
         raw_schema = cursor.fetchall()
         pretty_schema = format_postgresql_create_table(table, raw_schema)
         schemas[table] = pretty_schema
-    schema_prompt = "\n\n".join(schemas.values())
     db.close()
-    return schema_prompt
+    return schemas
+
+
+def generate_schema_prompt_postgresql(db_path):
+    return "\n\n".join(generate_schema_dict_postgresql(db_path).values())
+
+
+def fetch_columns_mysql():
+    """
+    Fetch the columns of every BIRD table in one information_schema query,
+    in the same (Field, Type, Null, Key, Default, Extra) layout as DESCRIBE.
+    """
+    db = connect_mysql()
+    cursor = db.cursor()
+    cursor.execute(
+        """
+            SELECT table_name, column_name, column_type, is_nullable,
+                   column_key, column_default, extra
+            FROM information_schema.columns
+            WHERE table_schema = 'BIRD'
+            ORDER BY table_name, ordinal_position;
+        """
+    )
+    columns = {}
+    for table_name, *column_info in cursor.fetchall():
+        columns.setdefault(table_name.lower(), []).append(tuple(column_info))
+    db.close()
+    return columns
+
+
+def fetch_columns_postgresql():
+    """
+    Fetch the columns of every table in db_table_map (in POSTGRESQL_SCHEMA)
+    in one information_schema query.
+    """
+    all_tables = [table for tables in db_table_map.values() for table in tables]
+    db = connect_postgresql()
+    cursor = db.cursor()
+    cursor.execute(
+        """
+            SELECT table_name, column_name, data_type, is_nullable
+            FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = ANY(%s)
+            ORDER BY table_name, ordinal_position;
+        """,
+        (POSTGRESQL_SCHEMA, all_tables),
+    )
+    columns = {}
+    for table_name, *column_info in cursor.fetchall():
+        columns.setdefault(table_name, []).append(tuple(column_info))
+    db.close()
+    return columns
+
+
+# {sql_dialect: {db_name: {table_name: ddl}}}, filled by preload_schema_dicts
+_bulk_schema_dicts = {}
+
+
+def preload_schema_dicts(sql_dialect):
+    """
+    Build the schema of every database in db_table_map from a single bulk
+    query, so that MySQL/PostgreSQL prompts are served from memory afterwards.
+    """
+    if sql_dialect == "MySQL":
+        columns = fetch_columns_mysql()
+        lookup, format_create_table = str.lower, format_mysql_create_table
+    elif sql_dialect == "PostgreSQL":
+        columns = fetch_columns_postgresql()
+        lookup, format_create_table = str, format_postgresql_create_table
+    else:
+        raise ValueError("Bulk schema extraction is not supported for {}".format(sql_dialect))
+
+    db_schemas = {}
+    for db_name, tables in db_table_map.items():
+        # databases with a missing table fall back to the per-table queries
+        if any(lookup(table) not in columns for table in tables):
+            continue
+        db_schemas[db_name] = {
+            table: format_create_table(table, columns[lookup(table)])
+            for table in tables
+        }
+    _bulk_schema_dicts[sql_dialect] = db_schemas
+    return db_schemas
+
+
+def generate_schema_dict(sql_dialect, db_path=None, num_rows=None):
+    if sql_dialect in _bulk_schema_dicts:
+        db_name = db_path.split("/")[-1].split(".sqlite")[0]
+        if db_name in _bulk_schema_dicts[sql_dialect]:
+            return _bulk_schema_dicts[sql_dialect][db_name]
+
+    if sql_dialect == "SQLite":
+        return generate_schema_dict_sqlite(db_path, num_rows)
+    elif sql_dialect == "MySQL":
+        return generate_schema_dict_mysql(db_path)
+    elif sql_dialect == "PostgreSQL":
+        return generate_schema_dict_postgresql(db_path)
+    else:
+        raise ValueError("Unsupported SQL dialect: {}".format(sql_dialect))
 
 
 def generate_schema_prompt(sql_dialect, db_path=None, num_rows=None):
@@ -266,3 +377,84 @@ def generate_schema_prompt(sql_dialect, db_path=None, num_rows=None):
         return generate_schema_prompt_postgresql(db_path)
     else:
         raise ValueError("Unsupported SQL dialect: {}".format(sql_dialect))
+
+
+# Schema prompts only depend on the database file, so they are memoized per
+# (db path, file mtime/size, dialect, num_rows) instead of being rebuilt for
+# every question. Touching or replacing the database file invalidates them.
+_schema_cache = {}
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+    except (OSError, TypeError):
+        return None, None
+
+
+def schema_cache_key(sql_dialect, db_path=None, num_rows=None, column_stats=False):
+    mtime, size = _file_state(db_path)
+    abs_path = os.path.abspath(db_path) if db_path else None
+    # a rebuilt statistics sidecar must invalidate prompts that embed it
+    stats_mtime = _file_state(column_stats_path(db_path))[0] if column_stats else None
+    return (abs_path, mtime, size, sql_dialect, num_rows, stats_mtime)
+
+
+def _schema_cache_file(cache_dir, key):
+    digest = hashlib.sha1(json.dumps(key).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"schema_{digest}.json")
+
+
+def _load_schema_cache_file(cache_file, key):
+    try:
+        with open(cache_file, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != list(key):
+        return None
+    return cached.get("schemas")
+
+
+def _dump_schema_cache_file(cache_file, key, schemas):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"key": list(key), "schemas": schemas}, f)
+    os.replace(tmp_file, cache_file)
+
+
+def get_schema_dict(
+    sql_dialect, db_path=None, num_rows=None, cache_dir=None, column_stats=False
+):
+    """
+    Return {table_name: ddl} for a database, served from the in-memory cache,
+    then from cache_dir (if given), and only built from the database on a miss.
+    With column_stats, the precomputed value statistics sidecar is appended.
+    """
+    key = schema_cache_key(sql_dialect, db_path, num_rows, column_stats)
+    schemas = _schema_cache.get(key)
+    if schemas is not None:
+        return schemas
+
+    cache_file = _schema_cache_file(cache_dir, key) if cache_dir else None
+    if cache_file:
+        schemas = _load_schema_cache_file(cache_file, key)
+    if schemas is None:
+        schemas = generate_schema_dict(sql_dialect, db_path, num_rows)
+        stats = load_column_stats(db_path) if column_stats else None
+        if stats:
+            schemas = add_column_stats(schemas, stats)
+        if cache_file:
+            _dump_schema_cache_file(cache_file, key, schemas)
+
+    _schema_cache[key] = schemas
+    return schemas
+
+
+def generate_schema_prompt_cached(
+    sql_dialect, db_path=None, num_rows=None, cache_dir=None, column_stats=False
+):
+    schemas = get_schema_dict(sql_dialect, db_path, num_rows, cache_dir, column_stats)
+    return "\n\n".join(schemas.values())
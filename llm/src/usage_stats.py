@@ -0,0 +1,33 @@
+"""
+Aggregate token usage reported by the API, in particular the share of prompt
+tokens served from the provider's prefix (prompt) cache.
+"""
+import threading
+
+
+class PrefixCacheStats:
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._lock = threading.Lock()
+
+    def record(self, response):
+        # plain-text results (instruct engine, cache hits, errors) carry no usage
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.cached_tokens += cached_tokens
+
+    def hit_ratio(self):
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def summary(self):
+        return "prefix cache: {} of {} prompt tokens cached ({:.1%}) over {} requests".format(
+            self.cached_tokens, self.prompt_tokens, self.hit_ratio(), self.requests
+        )
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+SQLite FTS5 index of database values.
+
+For every database, the distinct text values of all columns are stored in a
+sidecar <index_root>/<db_id>.fts.sqlite, so that literals mentioned in a question
+can be matched to (table, column, value) without an external BM25 index.
+An index is only rebuilt when the hash of its database file changes.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
+
+from tqdm import tqdm
+
+
+INDEX_VERSION = "1"
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "did", "do", "does", "for",
+    "from", "has", "have", "how", "in", "is", "it", "list", "many", "much", "of",
+    "on", "or", "please", "state", "the", "their", "there", "to", "was", "were",
+    "what", "when", "where", "which", "who", "whose", "with",
+}
+
+_index_connections = {}
+_index_connections_lock = threading.Lock()
+
+
+def index_path(index_root, db_id):
+    return os.path.join(index_root, f"{db_id}.fts.sqlite")
+
+
+def quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_index_meta(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        meta = dict(conn.execute("SELECT key, value FROM index_meta"))
+        conn.close()
+    except sqlite3.Error:
+        return {}
+    return meta
+
+
+def read_table_values(db_path, table, max_value_len=100):
+    """
+    Return the distinct text values of every column of one table as
+    (table, column, value) rows.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    quoted_table = quote_identifier(table)
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({quoted_table})")]
+    rows = []
+    for column in columns:
+        quoted_column = quote_identifier(column)
+        cursor = conn.execute(
+            f"SELECT DISTINCT {quoted_column} FROM {quoted_table} "
+            f"WHERE typeof({quoted_column}) = 'text' "
+            f"AND length({quoted_column}) BETWEEN 1 AND {max_value_len}"
+        )
+        rows.extend((table, column, value) for (value,) in cursor)
+    conn.close()
+    return rows
+
+
+def build_value_index(
+    db_path, index_root, executor, max_value_len=100, force=False
+):
+    """
+    (Re)build the index of one database, reading its tables through executor.
+    Returns False when the existing index is already up to date.
+    """
+    db_id = os.path.splitext(os.path.basename(db_path))[0]
+    target = index_path(index_root, db_id)
+    db_hash = file_hash(db_path)
+    meta = read_index_meta(target)
+    if (
+        not force
+        and meta.get("db_hash") == db_hash
+        and meta.get("version") == INDEX_VERSION
+    ):
+        return False
+
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    tables = [
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+    conn.close()
+
+    # build next to the target and swap it in, so readers never see a partial index
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    index_conn = sqlite3.connect(tmp_path)
+    index_conn.execute("PRAGMA journal_mode = OFF")
+    index_conn.execute("PRAGMA synchronous = OFF")
+    index_conn.execute(
+        "CREATE VIRTUAL TABLE values_fts USING fts5("
+        "value, tbl UNINDEXED, col UNINDEXED, tokenize = 'unicode61 remove_diacritics 2')"
+    )
+    index_conn.execute("CREATE TABLE index_meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    futures = [
+        executor.submit(read_table_values, db_path, table, max_value_len)
+        for table in tables
+    ]
+    for future in concurrent.futures.as_completed(futures):
+        index_conn.executemany(
+            "INSERT INTO values_fts (tbl, col, value) VALUES (?, ?, ?)",
+            future.result(),
+        )
+    index_conn.execute("INSERT INTO values_fts (values_fts) VALUES ('optimize')")
+    index_conn.executemany(
+        "INSERT INTO index_meta (key, value) VALUES (?, ?)",
+        [("db_hash", db_hash), ("version", INDEX_VERSION), ("db_id", db_id)],
+    )
+    index_conn.commit()
+    index_conn.close()
+    os.replace(tmp_path, target)
+
+    with _index_connections_lock:
+        stale = _index_connections.pop(target, None)
+    if stale is not None:
+        stale[0].close()
+    return True
+
+
+def build_value_indexes(
+    db_root_path, index_root, num_threads=8, max_value_len=100, force=False
+):
+    """
+    Build the indexes of every <db_root_path>/<db_id>/<db_id>.sqlite, with
+    databases and their tables processed in parallel by num_threads readers.
+    """
+    os.makedirs(index_root, exist_ok=True)
+    db_paths = sorted(
+        os.path.join(db_root_path, db_id, db_id + ".sqlite")
+        for db_id in os.listdir(db_root_path)
+        if os.path.exists(os.path.join(db_root_path, db_id, db_id + ".sqlite"))
+    )
+    rebuilt = []
+    # table readers and per-database writers live in separate pools, so that a
+    # writer waiting on its tables never occupies a reader slot
+    with ThreadPoolExecutor(max_workers=num_threads) as readers, ThreadPoolExecutor(
+        max_workers=min(num_threads, max(len(db_paths), 1))
+    ) as writers:
+        future_to_db = {
+            writers.submit(
+                build_value_index, db_path, index_root, readers, max_value_len, force
+            ): db_path
+            for db_path in db_paths
+        }
+        for future in tqdm(
+            concurrent.futures.as_completed(future_to_db), total=len(future_to_db)
+        ):
+            if future.result():
+                rebuilt.append(future_to_db[future])
+    return rebuilt
+
+
+def extract_literals(question):
+    """
+    Split a question into quoted phrases and the remaining keywords.
+    """
+    phrases = [a or b for a, b in re.findall(r"'([^']+)'|\"([^\"]+)\"", question)]
+    remainder = re.sub(r"'[^']+'|\"[^\"]+\"", " ", question)
+    keywords = [
+        word
+        for word in re.findall(r"\w+", remainder)
+        if word.lower() not in STOPWORDS and len(word) > 1
+    ]
+    return phrases, keywords
+
+
+def _fts_phrase(text):
+    return '"{}"'.format(text.replace('"', '""'))
+
+
+def _get_index_connection(index_root, db_id):
+    path = index_path(index_root, db_id)
+    with _index_connections_lock:
+        entry = _index_connections.get(path)
+        if entry is None:
+            if not os.path.exists(path):
+                return None
+            conn = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+            entry = (conn, threading.Lock())
+            _index_connections[path] = entry
+    return entry
+
+
+def lookup_values(index_root, db_id, question, top_k=10):
+    """
+    Match the literals of a question against the value index of db_id.
+    Returns up to top_k (table, column, value) tuples, exact phrases first.
+    """
+    entry = _get_index_connection(index_root, db_id)
+    if entry is None:
+        return []
+    conn, lock = entry
+    phrases, keywords = extract_literals(question)
+    queries = [_fts_phrase(phrase) for phrase in phrases]
+    if keywords:
+        queries.append(" OR ".join(_fts_phrase(word) for word in keywords))
+
+    matches = []
+    with lock:
+        for query in queries:
+            try:
+                rows = conn.execute(
+                    "SELECT tbl, col, value FROM values_fts WHERE values_fts MATCH ? "
+                    "ORDER BY rank LIMIT ?",
+                    (query, top_k),
+                ).fetchall()
+            except sqlite3.OperationalError:
+                continue
+            for row in rows:
+                if row not in matches:
+                    matches.append(row)
+    return matches[:top_k]
+
+
+if __name__ == "__main__":
+    args_parser = argparse.ArgumentParser()
+    args_parser.add_argument("--db_root_path", type=str, required=True)
+    args_parser.add_argument("--index_root", type=str, required=True)
+    args_parser.add_argument("--num_threads", type=int, default=8)
+    args_parser.add_argument("--max_value_len", type=int, default=100)
+    args_parser.add_argument("--force", type=str, default="False")
+    args = args_parser.parse_args()
+
+    rebuilt = build_value_indexes(
+        args.db_root_path,
+        args.index_root,
+        num_threads=args.num_threads,
+        max_value_len=args.max_value_len,
+        force=args.force == "True",
+    )
+    print("rebuilt {} value indexes under {}".format(len(rebuilt), args.index_root))